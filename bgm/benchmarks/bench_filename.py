@@ -0,0 +1,63 @@
+"""Check bgm.filename against the golden corpus and measure parser throughput.
+
+usage: python benchmarks/bench_filename.py [-n ROUNDS]
+"""
+
+import argparse
+import json
+from pathlib import Path
+import time
+
+from bgm.filename import parse_filename, parse_many
+
+CORPUS_PATH = Path(__file__).parent / "filename_corpus.json"
+
+
+def check(corpus: list[dict]) -> int:
+    failed = 0
+    for item in corpus:
+        info = parse_filename(item["filename"])
+        if (info.title, info.episode) != (item["title"], item["episode"]):
+            failed += 1
+            print(
+                f"MISMATCH {item['filename']}\n"
+                f"  expected: {item['title']!r} ep={item['episode']}\n"
+                f"  got:      {info.title!r} ep={info.episode}"
+            )
+    print(f"corpus: {len(corpus) - failed}/{len(corpus)} passed")
+    return failed
+
+
+def bench(filenames: list[str], rounds: int):
+    uncached = parse_filename.__wrapped__
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for filename in filenames:
+            uncached(filename)
+    cold = time.perf_counter() - start
+
+    parse_filename.cache_clear()
+    parse_many(filenames)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        parse_many(filenames)
+    warm = time.perf_counter() - start
+
+    total = rounds * len(filenames)
+    print(f"cold: {total / cold:,.0f} names/s ({cold / total * 1e6:.2f} us/name)")
+    print(f"warm: {total / warm:,.0f} names/s ({warm / total * 1e6:.2f} us/name)")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="filename parser benchmark")
+    parser.add_argument("-n", "--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    corpus = json.loads(CORPUS_PATH.read_text(encoding="utf-8"))
+    failed = check(corpus)
+    bench([item["filename"] for item in corpus], args.rounds)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,115 @@
+"""Measure the cold start of the bgm helper process against a time budget.
+
+ready: imports needed before `ready` is sent to mpv
+full:  import of bgm.mpvbangumi, needed before the first action is handled
+
+Times are medians over fresh interpreters, minus a bare `python -c pass`.
+bgm.mpvbangumi needs a config and opens the db on import, the interpreters
+get a throwaway config and data dir (XDG_*_HOME, so only where appdirs honors
+them). Elsewhere the full phase uses the real ones and is skipped without a
+config.
+
+usage: python benchmarks/bench_startup.py [-n ROUNDS] [--top N]
+                                          [--ready-budget MS] [--full-budget MS]
+"""
+
+import argparse
+import os
+from pathlib import Path
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from appdirs import user_config_dir
+
+PHASES = {
+    "ready": "import python_mpv_jsonipc, bgm",
+    "full": "import bgm.mpvbangumi",
+}
+IMPORTTIME_RE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)")
+
+
+def isolated_env(tmp: Path) -> dict[str, str] | None:
+    """environment with a minimal config in `tmp`, None where appdirs ignores XDG"""
+    if sys.platform in ("win32", "darwin"):
+        return None
+    config_path = tmp / "config" / "bgm"
+    config_path.mkdir(parents=True)
+    (config_path / "config.toml").write_text(
+        f"storages = [{str(tmp)!r}]\n\n[danmaku]\n", encoding="utf-8"
+    )
+    (config_path / ".env").write_text("BGM_ACCESS_TOKEN=benchmark\n", encoding="utf-8")
+    return {
+        **os.environ,
+        "XDG_CONFIG_HOME": str(tmp / "config"),
+        "XDG_DATA_HOME": str(tmp / "data"),
+    }
+
+
+def run(code: str, *args: str, env: dict[str, str] | None = None) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *args, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=env,
+    )
+
+
+def wall_time(code: str, rounds: int, env: dict[str, str] | None = None) -> float:
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        run(code, env=env)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def top_imports(code: str, top: int, env: dict[str, str] | None = None):
+    """the modules of `code` with the highest self import time"""
+    res = run(code, "-X", "importtime", env=env)
+    rows = []
+    for line in res.stderr.splitlines():
+        if m := IMPORTTIME_RE.match(line):
+            self_us, cumulative_us, _, name = m.groups()
+            rows.append((int(self_us), int(cumulative_us), name))
+    for self_us, cumulative_us, name in sorted(rows, reverse=True)[:top]:
+        print(f"  {self_us / 1000:7.1f} ms  (cumulative {cumulative_us / 1000:7.1f} ms)  {name}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="bgm helper startup benchmark")
+    parser.add_argument("-n", "--rounds", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10, help="slowest imports to show")
+    parser.add_argument("--ready-budget", type=float, default=100.0, help="ms")
+    parser.add_argument("--full-budget", type=float, default=650.0, help="ms")
+    args = parser.parse_args()
+    budgets = {"ready": args.ready_budget, "full": args.full_budget}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = isolated_env(Path(tmp))
+        phases = dict(PHASES)
+        if env is None and not (Path(user_config_dir("bgm")) / "config.toml").exists():
+            print("full: skipped, no config.toml (run `bgm` once to create it)")
+            del phases["full"]
+
+        # warm the bytecode and disk caches, and create the db
+        run(phases.get("full", phases["ready"]), env=env)
+        baseline = wall_time("pass", args.rounds)
+        print(f"interpreter: {baseline:.1f} ms")
+
+        over = 0
+        for phase, code in phases.items():
+            elapsed = wall_time(code, args.rounds, env) - baseline
+            status = "ok" if elapsed <= budgets[phase] else "OVER BUDGET"
+            over += elapsed > budgets[phase]
+            print(f"{phase}: {elapsed:.1f} ms (budget {budgets[phase]:.0f} ms) {status}")
+            top_imports(code, args.top, env)
+    return 1 if over else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -14,6 +14,9 @@ LOG_LEVEL = (
     logging.INFO if os.environ.get("BGM_DEBUG") in (None, "0") else logging.DEBUG
 )
 
+# mpv property the lua script writes actions to
+PROPERTY_DISPATCH = "user-data/mpv_bangumi/dispatch"
+
 NOTIFY_LEVEL_NUM = 50
 logging.addLevelName(NOTIFY_LEVEL_NUM, "NOTIFY")
 
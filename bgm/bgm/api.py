@@ -1,15 +1,217 @@
+import asyncio
+import contextlib
+import copy
+from email.utils import parsedate_to_datetime
 import os
 import json
+import time
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Hashable
+from urllib.parse import urlsplit
 import aiohttp
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from tenacity import RetryCallState, retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 from bgm import logger
 from bgm import DATA_PATH
+from bgm.config import RateLimitConfig, config
+from bgm.transport import transport
+
+if TYPE_CHECKING:
+    from bgm.db import CacheWriter
+
+class HTTPPool:
+    """Process-wide aiohttp session with keep-alive connections, shared by all API instances.
+
+    The session belongs to the event loop that created it (the AsyncWorker loop),
+    a new one is created if it is used from another loop.
+    """
+
+    WARMUP_HOSTS = ("https://api.dandanplay.net", "https://api.bgm.tv")
+
+    def __init__(self) -> None:
+        self.session: aiohttp.ClientSession | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.loop is not loop:
+            self.loop = loop
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit_per_host=8,
+                    ttl_dns_cache=600,
+                    keepalive_timeout=60,
+                ),
+                timeout=aiohttp.ClientTimeout(total=60),
+            )
+        return self.session
+
+    @contextlib.asynccontextmanager
+    async def request(self, method: str, url: str, **kwargs):
+        """session.request, routed through the record/replay transport when enabled"""
+        session = self.get_session()
+        if not transport.active:
+            async with session.request(method, url, **kwargs) as res:
+                yield res
+            return
+
+        url_, body = transport.prepare(url, kwargs)
+        target = transport.rewrite(url_) if transport.replay_url else url_
+        async with session.request(method, target, **kwargs) as res:
+            if transport.record_dir:
+                await transport.record(method, url_, body, res)
+            yield res
+
+    async def warmup(self):
+        """open connections (DNS + TLS) to the api hosts ahead of the first request"""
+        if transport.active:
+            return
+
+        async def connect(url: str):
+            try:
+                async with self.get_session().head(url) as res:
+                    logger.debug("warmup %s: %d", url, res.status)
+            except aiohttp.ClientError as e:
+                logger.debug("warmup %s failed: %s", url, e)
+
+        await asyncio.gather(*(connect(url) for url in self.WARMUP_HOSTS))
+
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+
+http_pool = HTTPPool()
+
+
+class SingleFlight:
+    """Coalesce identical in-flight requests, concurrent callers share one round trip."""
+
+    def __init__(self) -> None:
+        self.calls: dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        if (fut := self.calls.get(key)) is not None:
+            logger.debug("single flight: join %s", key)
+        else:
+            fut = asyncio.ensure_future(fn())
+            self.calls[key] = fut
+            fut.add_done_callback(lambda _: self.calls.pop(key, None))
+        # callers may modify the result, the leader included, so nobody gets
+        # the shared object and everyone copies the untouched original
+        return copy.deepcopy(await asyncio.shield(fut))
+
+
+single_flight = SingleFlight()
+
+
+class HostLimiter:
+    """Token bucket plus a concurrency semaphore for one host."""
+
+    def __init__(self, host: str, limit: RateLimitConfig) -> None:
+        self.host = host
+        self.rate = limit.rate
+        self.burst = limit.burst
+        self.tokens = float(limit.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.semaphore = asyncio.Semaphore(limit.concurrency)
+        self.lock = asyncio.Lock()
+
+        self.requests = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def pause(self, seconds: float):
+        """hold back every request to this host, e.g. after a 429 with Retry-After"""
+        self.throttled += 1
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def _take_token(self):
+        async with self.lock:
+            if (delay := self.paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.tokens = 1
+                self.updated = time.monotonic()
+            self.tokens -= 1
+
+    @contextlib.asynccontextmanager
+    async def limit(self):
+        start = time.monotonic()
+        async with self.semaphore:
+            await self._take_token()
+            wait = time.monotonic() - start
+            self.requests += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            if wait > 1:
+                logger.debug("rate limit: waited %.1fs for %s", wait, self.host)
+            yield
+
+    def metrics(self) -> dict:
+        return {
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "avg_wait": self.total_wait / self.requests if self.requests else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+class RateLimiter:
+    def __init__(self) -> None:
+        self.hosts: dict[str, HostLimiter] = {}
+
+    def __call__(self, url: str) -> HostLimiter:
+        host = urlsplit(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = HostLimiter(
+                host, config.rate_limit.get(host) or RateLimitConfig()
+            )
+        return self.hosts[host]
+
+    def metrics(self) -> dict[str, dict]:
+        return {host: limiter.metrics() for host, limiter in self.hosts.items()}
+
+
+rate_limiter = RateLimiter()
+
+RETRY_AFTER_MAX = 60
+
+
+def get_retry_after(headers: Any) -> float | None:
+    """seconds to wait from a Retry-After header (delay or HTTP date)"""
+    value = headers and headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return min(float(value), RETRY_AFTER_MAX)
+    except ValueError:
+        pass
+    try:
+        return min(max(parsedate_to_datetime(value).timestamp() - time.time(), 0), RETRY_AFTER_MAX)
+    except (TypeError, ValueError):
+        return None
+
+
+def wait_retry_after(retry_state: RetryCallState) -> float:
+    """honour the server provided delay, fall back to exponential backoff"""
+    exc = retry_state.outcome.exception() if retry_state.outcome else None
+    if isinstance(exc, aiohttp.ClientResponseError):
+        if (delay := get_retry_after(exc.headers)) is not None:
+            return delay
+    return wait_exponential(multiplier=1, min=2, max=10)(retry_state)
+
 
 class API:
     API_BASE=""
     def __init__(self) -> None:
         self.headers = {}
-        self.session = None
+        self.session: aiohttp.ClientSession | None = None
         self._include_status_code = False
 
     async def __aenter__(self):
@@ -21,28 +223,60 @@ class API:
 
 
     async def init_session(self):
-        if self.session is None or self.session.closed:
-            self.session = aiohttp.ClientSession(headers=self.headers)
-        
+        self.session = http_pool.get_session()
 
     async def close(self):
-        if self.session and not self.session.closed:
-            await self.session.close()
+        # the pooled session outlives this view
+        self.session = None
+
+    async def _request(
+        self, method: str, url: str, cache: "CacheWriter | None" = None, **kwargs
+    ) -> Any:
+        """With `cache`, the request is conditional and None is returned if the cached file is still valid."""
+        # conditional requests are already serialized by the cache file lock
+        if method != "GET" or cache is not None:
+            return await self._send(method, url, cache, **kwargs)
+
+        parts = urlsplit(url)
+        params = kwargs.get("params") or {}
+        key = (
+            parts.netloc,
+            method,
+            parts.path,
+            tuple(sorted((k, str(v)) for k, v in params.items())),
+            self._include_status_code,
+        )
+        return await single_flight.do(key, lambda: self._send(method, url, None, **kwargs))
 
     @retry(
         stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=2, max=10),
+        wait=wait_retry_after,
         retry=retry_if_exception_type((aiohttp.ClientError, aiohttp.ClientResponseError)),
         reraise=True
     )
-    async def _request(self, method: str, url: str, **kwargs) -> dict:
+    async def _send(
+        self, method: str, url: str, cache: "CacheWriter | None", **kwargs
+    ) -> Any:
         if self.session is None or self.session.closed:
             raise RuntimeError("Session is not initialized. Please use 'async with' or call 'await api.init_session()'.")
 
-        async with self.session.request(method, url, **kwargs) as res:
+        kwargs["headers"] = self.headers | kwargs.get("headers", {})
+        if cache is not None:
+            kwargs["headers"] |= cache.conditional_headers
+        limiter = rate_limiter(url)
+        async with limiter.limit(), http_pool.request(method, url, **kwargs) as res:
             if res.status >= 500 or res.status == 429:
+                if (delay := get_retry_after(res.headers)) is not None:
+                    limiter.pause(delay)
                 res.raise_for_status()
 
+            if cache is not None:
+                if res.status == 304:
+                    logger.debug("not modified: %s", url)
+                    cache.set_not_modified()
+                    return None
+                cache.set_validators(res.headers)
+
             try:
                 res_json = await res.json()
             except (aiohttp.ContentTypeError, json.JSONDecodeError):
@@ -53,8 +287,12 @@ class API:
                 res_json["status_code"] = res.status
             return res_json
 
-    async def get(self, uri: str, params: dict | None = None):
-        return await self._request("GET", self.API_BASE + uri, params=params or {})
+    async def get(
+        self, uri: str, params: dict | None = None, cache: "CacheWriter | None" = None
+    ):
+        return await self._request(
+            "GET", self.API_BASE + uri, cache=cache, params=params or {}
+        )
 
     async def post(self, uri: str, data: dict | None = None):
         return await self._request("POST", self.API_BASE + uri, json=data or {})
@@ -62,6 +300,9 @@ class API:
     async def put(self, uri: str, data: dict | None = None):
         return await self._request("PUT", self.API_BASE + uri, json=data or {})
 
+    async def patch(self, uri: str, data: dict | None = None):
+        return await self._request("PATCH", self.API_BASE + uri, json=data or {})
+
 
 class BangumiAPI(API):
     API_BASE = "https://api.bgm.tv"
@@ -71,6 +312,8 @@ class BangumiAPI(API):
         "Content-Type": "application/json",
         "User-Agent": "mpv_bangumi/private",
     }
+    # resolved once per process
+    _username: str | None = None
 
     def __init__(self):
         super().__init__()
@@ -78,12 +321,13 @@ class BangumiAPI(API):
         self.headers = self.default_headers | {
             "Authorization": f"Bearer {self.ACCESS_TOKEN}"
         }
-        self.username = None
+        self.username = BangumiAPI._username
 
     async def init_session(self):
         await super().init_session()
         if not self.username:
             await self._init_username()
+            BangumiAPI._username = self.username
 
     async def _init_username(self):
         username_file = DATA_PATH / "username.json"
@@ -119,6 +363,15 @@ class BangumiAPI(API):
     async def get_user_collection(self, subject_id: int):
         return await self.get(f"/v0/users/{self.username}/collections/{subject_id}")
 
+    async def get_user_collections(
+        self, subject_type: int = 2, offset: int = 0, limit: int = 100
+    ):
+        """subject_type 2: 动画"""
+        return await self.get(
+            f"/v0/users/{self.username}/collections",
+            {"subject_type": subject_type, "offset": offset, "limit": limit},
+        )
+
     async def update_user_collection(
         self, subject_id: int, status: int = 3, private: bool = False
     ):
@@ -128,15 +381,27 @@ class BangumiAPI(API):
             data={"type": status, "private": private},
         )
 
-    async def get_user_episodes(self, subject_id: int):
+    async def get_user_episodes(
+        self, subject_id: int, cache: "CacheWriter | None" = None
+    ):
         return await self.get(
             f"/v0/users/-/collections/{subject_id}/episodes",
             {"offset": 0, "limit": 1000, "episode_type": 0},
+            cache=cache,
         )
 
     async def get_episode_status(self, episode_id: int):
         return await self.get(f"/v0/users/-/collections/-/episodes/{episode_id}")
 
+    async def update_episodes_status(
+        self, subject_id: int, episode_ids: list[int], status: int = 2
+    ):
+        """status 0: 未收藏, 1: 想看, 2: 看过, 3: 抛弃"""
+        return await self.patch(
+            f"/v0/users/-/collections/{subject_id}/episodes",
+            data={"episode_id": episode_ids, "type": status},
+        )
+
     async def update_episode_status(self, episode_id: int, status: int = 2):
         """status 0: 未收藏, 1: 想看, 2: 看过, 3: 抛弃"""
         return await self.put(
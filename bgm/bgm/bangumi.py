@@ -1,42 +1,203 @@
+import asyncio
 import json
-from typing import TYPE_CHECKING
+from collections import Counter, defaultdict
+import re
+from typing import TYPE_CHECKING, Coroutine
 from bgm.api import BangumiAPI
 from bgm.dandanplay import construct_episode_match
-from bgm.db import db
-from bgm import logger
+from bgm.db import SyncItem, db
+from bgm import DATA_PATH, logger
 
 if TYPE_CHECKING:
     from bgm.mpvbangumi import MPVBangumi
 
 
-async def bangumi_update_collection(ctx: "MPVBangumi", subject_id: int):
-    """Update Bangumi collection for a given subject ID."""
-    async with BangumiAPI() as api:
-        info: dict = await api.get_user_collection(subject_id)
+COLLECTIONS_PATH = DATA_PATH / "collections.json"
+COLLECTIONS_MAX_AGE = 3600
+COLLECTIONS_PAGE_SIZE = 100
+
+OUTBOX_FLUSH_DELAY = 3
+OUTBOX_RETRY_DELAY = 300
+# an update is dropped after failing this many flushes
+OUTBOX_MAX_ATTEMPTS = 10
+# 4xx worth retrying, 401 recovers once the access token is renewed
+OUTBOX_RETRY_STATUSES = (401, 408, 429)
+
+_flush_lock = asyncio.Lock()
+_flush_handle: asyncio.TimerHandle | None = None
+_flush_tasks: set[asyncio.Task] = set()
+
+
+def schedule_outbox_flush(delay: float = OUTBOX_FLUSH_DELAY):
+    """flush the outbox after `delay`, an earlier pending flush is kept"""
+    global _flush_handle
+    loop = asyncio.get_running_loop()
+    when = loop.time() + delay
+    if _flush_handle is not None:
+        if _flush_handle.when() <= when:
+            return
+        _flush_handle.cancel()
+
+    def fire():
+        global _flush_handle
+        _flush_handle = None
+        task = loop.create_task(bangumi_flush_outbox())
+        _flush_tasks.add(task)
+        task.add_done_callback(_flush_tasks.discard)
+
+    _flush_handle = loop.call_at(when, fire)
+
+
+class PermanentSyncError(Exception):
+    """rejected by bangumi.tv, sending the update again will not help"""
+
+
+def _check_sync_response(res: dict, what: str) -> bool:
+    """True on success, False if worth retrying, raises PermanentSyncError otherwise"""
+    status_code = res["status_code"]
+    if status_code < 400:
+        return True
+    if status_code < 500 and status_code not in OUTBOX_RETRY_STATUSES:
+        raise PermanentSyncError(f"{what}: {res}")
+    logger.error("Failed to %s %s", what, res)
+    return False
+
+
+def _update_from(status: int | None) -> str | None:
+    """the status name to move to 在看 from, None if no update is needed"""
+    if status is None:
+        return "未看"
+    assert isinstance(status, int) and status in [1, 2, 3, 4, 5], (
+        "Invalid status code"
+    )
+    return (
+        "想看",
+        None,  # 看过
+        None,  # 在看
+        "搁置",
+        "抛弃",
+    )[status - 1]
+
+
+async def bangumi_refresh_collections():
+    """mirror the user's anime collection statuses into the db, at most once per max age"""
+    async with db.check_update_async(COLLECTIONS_PATH, COLLECTIONS_MAX_AGE) as writer:
+        if writer is None:
+            return
+        async with BangumiAPI() as api:
+            first = await api.get_user_collections(limit=COLLECTIONS_PAGE_SIZE)
+            if first["status_code"] >= 400:
+                logger.error("Failed to fetch Bangumi collections %s", first)
+                return
+            pages = await asyncio.gather(
+                *(
+                    api.get_user_collections(offset=offset, limit=COLLECTIONS_PAGE_SIZE)
+                    for offset in range(
+                        COLLECTIONS_PAGE_SIZE, first["total"], COLLECTIONS_PAGE_SIZE
+                    )
+                )
+            )
+        statuses = {
+            item["subject_id"]: item["type"]
+            for page in (first, *pages)
+            for item in page["data"]
+        }
+        db.replace_collections(statuses)
+        writer(json.dumps(statuses))
+        logger.debug("mirrored %d Bangumi collections", len(statuses))
+
+
+async def _sync_collection(api: BangumiAPI, item: SyncItem) -> bool:
+    status = db.get_collection_status(item.subject_id)
+    if status is None:
+        # not in the mirror, make sure it is not collected since the last refresh
+        info: dict = await api.get_user_collection(item.subject_id)
         status = info.get("type")
-        # ep_status = info.get("ep_status")
+        if status is None and info["status_code"] != 404:
+            if _check_sync_response(info, "get collection status"):
+                raise PermanentSyncError(f"get collection status: no type in {info}")
+            return False
+    update_from = _update_from(status)
+    if status is not None and update_from is None:
+        # already 看过 or 在看, a 404 (not collected) goes on to the update below
+        db.set_collection_status(item.subject_id, status)
+        return True
+
+    res = await api.update_user_collection(item.subject_id, status=item.status)
+    if not _check_sync_response(res, "update collection status"):
+        return False
+    db.set_collection_status(item.subject_id, item.status)
+    logger.notify(f"条目状态更新：{update_from} → 在看")
+    return True
+
+
+async def _sync_episodes(
+    api: BangumiAPI, subject_id: int, status: int, items: list[SyncItem]
+) -> bool:
+    episode_ids = [item.target_id for item in items]
+    res = await api.update_episodes_status(subject_id, episode_ids, status=status)
+    if not _check_sync_response(res, "update episode status"):
+        return False
+    db.set_episode_status(subject_id, episode_ids, status)
+    logger.notify("同步Bangumi追番记录进度成功")
+    return True
 
-        if status is None:
-            assert info["status_code"] == 404
-            update_message = "条目状态更新：未看 → 在看"
-            await api.update_user_collection(subject_id, status=3)
-            logger.notify(update_message)
+
+async def bangumi_flush_outbox():
+    """send pending updates, episodes of the same subject share one request"""
+    async with _flush_lock:
+        items = db.get_pending_sync()
+        if not items:
             return
 
-        assert isinstance(status, int) and status in [1, 2, 3, 4, 5], (
-            "Invalid status code"
-        )
-        update_from = (
-            "想看",
-            None,  # 看过
-            None,  # 在看
-            "搁置",
-            "抛弃",
-        )[status - 1]
-        if update_from is not None:
-            await api.update_user_collection(subject_id, status=3)
-            update_message = f"条目状态更新：{update_from} → 在看"
-            logger.notify(update_message)
+        episodes: defaultdict[tuple[int, int], list[SyncItem]] = defaultdict(list)
+        batches: list[tuple[list[SyncItem], Coroutine]] = []
+        async with BangumiAPI() as api:
+            for item in items:
+                if item.kind == "collection":
+                    batches.append(([item], _sync_collection(api, item)))
+                else:
+                    episodes[(item.subject_id, item.status)].append(item)
+            for (subject_id, status), group in episodes.items():
+                batches.append((group, _sync_episodes(api, subject_id, status, group)))
+
+            results = await asyncio.gather(
+                *(coro for _, coro in batches), return_exceptions=True
+            )
+
+        failed = False
+        for (group, _), result in zip(batches, results):
+            if result is True:
+                db.finish_sync(group)
+            elif isinstance(result, (PermanentSyncError, AssertionError)):
+                logger.error("Dropped Bangumi update %s: %r", group, result)
+                db.finish_sync(group)
+            else:
+                if isinstance(result, BaseException):
+                    logger.error("Failed to sync with Bangumi: %r", result)
+                db.fail_sync(group)
+                expired = [item for item in group if item.attempts + 1 >= OUTBOX_MAX_ATTEMPTS]
+                if expired:
+                    logger.error(
+                        "Dropped Bangumi update after %d attempts: %s",
+                        OUTBOX_MAX_ATTEMPTS, expired,
+                    )
+                    db.finish_sync(expired)
+                failed = failed or len(expired) < len(group)
+        if failed:
+            schedule_outbox_flush(OUTBOX_RETRY_DELAY)
+
+
+async def bangumi_update_collection(ctx: "MPVBangumi", subject_id: int):
+    """Update Bangumi collection for a given subject ID."""
+    try:
+        await bangumi_refresh_collections()
+    except Exception as e:
+        logger.warning("Failed to refresh Bangumi collections: %r", e)
+    if _update_from(db.get_collection_status(subject_id)) is None:
+        return
+    db.enqueue_sync("collection", subject_id, subject_id, status=3)
+    schedule_outbox_flush()
 
 
 def fuzzy_match_title(t1: str, t2: str) -> float:
@@ -60,6 +221,110 @@ def fuzzy_match_title(t1: str, t2: str) -> float:
     return max(ratio1 + ratio2, SequenceMatcher(None, t1, t2).ratio())
 
 
+TITLE_NGRAM = 2
+TITLE_SHORTLIST_SIZE = 5
+# bumped when the layout of the cached title index changes
+TITLE_INDEX_VERSION = 2
+TITLE_MIN_CONFIDENCE = 0.8
+
+
+def normalize_title(title: str) -> list[str]:
+    return re.findall(r"\w+", title.lower())
+
+
+def title_ngrams(tokens: list[str]) -> set[str]:
+    text = "".join(tokens)
+    if len(text) < TITLE_NGRAM:
+        return {text} if text else set()
+    return {text[i : i + TITLE_NGRAM] for i in range(len(text) - TITLE_NGRAM + 1)}
+
+
+def build_title_index(episodes: list[dict]) -> dict:
+    """token sets and a character n-gram inverted index of episode name and name_cn"""
+    # (episode index, title, tokens, number of n-grams)
+    titles: list[tuple[int, str, list[str], int]] = []
+    grams: dict[str, list[int]] = {}
+    for i, ep_info in enumerate(episodes):
+        for key in ("name", "name_cn"):
+            title = ep_info["episode"].get(key, "")
+            if not title:
+                continue
+            tokens = normalize_title(title)
+            title_grams = title_ngrams(tokens)
+            for gram in title_grams:
+                grams.setdefault(gram, []).append(len(titles))
+            titles.append((i, title, sorted(set(tokens)), len(title_grams)))
+    return {
+        "version": TITLE_INDEX_VERSION,
+        "ngram": TITLE_NGRAM,
+        "titles": titles,
+        "grams": grams,
+    }
+
+
+def load_title_index(episode_id: int, episodes: list[dict]) -> dict:
+    episodes_path = db.get_path(episode_id, "episodes")
+    index_path = db.get_path(episode_id, "episodes-index")
+    if (
+        index_path.exists()
+        and index_path.stat().st_mtime >= episodes_path.stat().st_mtime
+    ):
+        try:
+            index = json.loads(index_path.read_text(encoding="utf-8"))
+            if (
+                index.get("version") == TITLE_INDEX_VERSION
+                and index.get("ngram") == TITLE_NGRAM
+            ):
+                return index
+        except json.JSONDecodeError:
+            pass
+    index = build_title_index(episodes)
+    index_path.write_text(json.dumps(index, ensure_ascii=False), encoding="utf-8")
+    return index
+
+
+def match_episode_title(title: str, index: dict) -> tuple[float, int | None]:
+    """Return the best (confidence, episode index).
+
+    Only shortlisted titles are fuzzy matched, every title is when none of
+    them reaches TITLE_MIN_CONFIDENCE.
+    """
+    tokens = normalize_title(title)
+    query_grams = title_ngrams(tokens)
+    hits: Counter[int] = Counter()
+    for gram in query_grams:
+        hits.update(index["grams"].get(gram, []))
+
+    token_set = set(tokens)
+
+    def score(tid: int) -> float:
+        # Dice coefficients, so long titles do not win by size alone
+        _, _, title_tokens, n_grams = index["titles"][tid]
+        gram_score = 2 * hits[tid] / (len(query_grams) + n_grams)
+        token_score = (
+            2 * len(token_set & set(title_tokens)) / (len(token_set) + len(title_tokens))
+            if token_set or title_tokens
+            else 0.0
+        )
+        return gram_score + token_score
+
+    shortlist = sorted(hits, key=lambda tid: (score(tid), -tid), reverse=True)
+
+    def best_of(tids) -> tuple[float, int | None]:
+        best_conf, best_idx = 0.0, None
+        for tid in tids:
+            idx, candidate, _, _ = index["titles"][tid]
+            conf = fuzzy_match_title(title, candidate)
+            if conf > best_conf:
+                best_conf, best_idx = conf, idx
+        return best_conf, best_idx
+
+    best = best_of(shortlist[:TITLE_SHORTLIST_SIZE])
+    if best[0] < TITLE_MIN_CONFIDENCE:
+        best = max(best, best_of(range(len(index["titles"]))), key=lambda b: b[0])
+    return best
+
+
 async def bangumi_update_episode(ctx: "MPVBangumi", subject_id: int, episode_id: int):
     """Update Bangumi episode status for a given subject ID and dandanplay episode ID."""
     ep = episode_id % 10000
@@ -80,21 +345,16 @@ async def bangumi_update_episode(ctx: "MPVBangumi", subject_id: int, episode_id:
             logger.error(f"Failed to match episode info for ID {episode_id}")
             return
         title = episode_info.episodeTitle
-        # Fuzzy match the title with the episodes
-        confs1 = [
-            fuzzy_match_title(title, ep_info["episode"].get("name", ""))
-            for ep_info in episodes
-        ]
-        confs2 = [
-            fuzzy_match_title(title, ep_info["episode"].get("name_cn", ""))
-            for ep_info in episodes
-        ]
-        confs = [max(c1, c2) for c1, c2 in zip(confs1, confs2)]
-        max_conf = max(confs)
-        idx = confs.index(max_conf)
+        # Fuzzy match the title with the shortlisted episodes
+        max_conf, idx = match_episode_title(
+            title, load_title_index(episode_id, episodes)
+        )
+        if idx is None:
+            logger.error(f"Failed to match episode title {title} with episodes")
+            return
         episode = episodes[idx]
         bgm_episode_id = episode["episode"]["id"]
-        if max_conf < 0.8:
+        if max_conf < TITLE_MIN_CONFIDENCE:
             logger.error(
                 f"Failed to match episode title {title} with episodes, max confidence {max_conf}: {episode}"
             )
@@ -110,18 +370,16 @@ async def bangumi_update_episode(ctx: "MPVBangumi", subject_id: int, episode_id:
         )
         bgm_episode_id = episode["episode"]["id"]
 
-    async with BangumiAPI() as api:
-        prev_status = await api.get_episode_status(bgm_episode_id)
-        if prev_status["type"] == 2:
-            logger.info(
-                f"Episode {bgm_episode_id} already marked as watched, skip updating."
-            )
-            return
-        res = await api.update_episode_status(bgm_episode_id, status=2)
-        if res["status_code"] >= 400:
-            logger.error("Failed to update episode status %s", res)
-            return
-        logger.notify("同步Bangumi追番记录进度成功")
+    prev_status = db.get_episode_status(bgm_episode_id)
+    if prev_status is None:
+        prev_status = episode.get("type")
+    if prev_status == 2:
+        logger.info(
+            f"Episode {bgm_episode_id} already marked as watched, skip updating."
+        )
+        return
+    db.enqueue_sync("episode", subject_id, bgm_episode_id, status=2)
+    schedule_outbox_flush()
 
 
 async def bangumi_fetch_episodes(ctx: "MPVBangumi", subject_id: int, episode_id: int):
@@ -130,8 +388,20 @@ async def bangumi_fetch_episodes(ctx: "MPVBangumi", subject_id: int, episode_id:
     async with db.check_update_async(episodes_path) as writer:
         if writer is not None:
             async with BangumiAPI() as api:
-                episodes = await api.get_user_episodes(subject_id)
+                episodes = await api.get_user_episodes(subject_id, cache=writer)
+            if writer.not_modified:
+                return
             assert episodes.get("data"), (
                 f"Failed to fetch episodes for Bangumi ID {subject_id}"
             )
             writer(json.dumps(episodes, ensure_ascii=False))
+            watched = defaultdict(list)
+            for item in episodes["data"]:
+                watched[item.get("type", 0)].append(item["episode"]["id"])
+            for status, episode_ids in watched.items():
+                db.set_episode_status(subject_id, episode_ids, status)
+            index_path = db.get_path(episode_id, "episodes-index")
+            index_path.write_text(
+                json.dumps(build_title_index(episodes["data"]), ensure_ascii=False),
+                encoding="utf-8",
+            )
@@ -1,6 +1,5 @@
 import random
 from typing import Literal
-import click
 import toml
 from bgm import CONFIG_PATH, logger
 from pathlib import Path
@@ -28,16 +27,28 @@ class LLMConfig(BaseModel):
     enabled: bool = False
     base_url: str = "https://api.openai.com/v1"
     model: str = "gpt-4o-mini"
+    # chunks translated at the same time
+    max_concurrency: int = 4
+
+
+class RateLimitConfig(BaseModel):
+    rate: float = 5.0  # requests per second
+    burst: int = 5
+    concurrency: int = 4
 
 
 class Config(BaseModel):
     storages: list[DirectoryPath]
     danmaku: DanmakuConfig
     llm: LLMConfig | None = None
+    # per host, e.g. [rate_limit."api.bgm.tv"]
+    rate_limit: dict[str, RateLimitConfig] = {}
 
 
 def init_config():
     """Initialize the config file."""
+    import click
+
     CONFIG_PATH.mkdir(parents=True, exist_ok=True)
     config_file = CONFIG_PATH / "config.toml"
     access_token = click.prompt(
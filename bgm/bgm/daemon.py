@@ -0,0 +1,170 @@
+"""One resident helper process shared by several mpv instances.
+
+`bgm --daemon <ipc>` hands the mpv IPC socket to a running daemon and exits,
+or becomes the daemon itself when none is running. The daemon connects to
+every handed over socket and serves it with its own MPVBangumi, all of them
+sharing the worker loop, the http pool, the db and the in-memory caches.
+"""
+
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+import getpass
+import os
+import secrets
+import sys
+import threading
+import time
+from typing import TYPE_CHECKING
+
+import portalocker
+
+from bgm import DATA_PATH, PROPERTY_DISPATCH, logger
+
+if TYPE_CHECKING:
+    from bgm.mpvbangumi import MPVBangumi
+
+if sys.platform == "win32":
+    ADDRESS = rf"\\.\pipe\mpv-bangumi-daemon-{getpass.getuser()}"
+else:
+    ADDRESS = str(DATA_PATH / "daemon.sock")
+LOCK_PATH = DATA_PATH / "daemon.lock"
+KEY_PATH = DATA_PATH / "daemon.key"
+
+ATTACH_TIMEOUT = 5
+# the daemon exits once no player has been attached for this long
+IDLE_TIMEOUT = 600
+
+_lock: portalocker.Lock | None = None
+
+
+def _authkey() -> bytes:
+    if not KEY_PATH.exists():
+        try:
+            fd = os.open(KEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, "wb") as f:
+                f.write(secrets.token_bytes(32))
+    return KEY_PATH.read_bytes()
+
+
+def attach(ipc_socket: str) -> bool:
+    """hand `ipc_socket` to the daemon, False if this process should serve it"""
+    global _lock
+    deadline = time.monotonic() + ATTACH_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            with Client(ADDRESS, authkey=_authkey()) as conn:
+                conn.send(ipc_socket)
+                if conn.recv() is True:
+                    return True
+        except (OSError, EOFError, AuthenticationError):
+            pass
+
+        lock = portalocker.Lock(LOCK_PATH, mode="w", timeout=0, fail_when_locked=True)
+        try:
+            lock.acquire()
+        except portalocker.LockException:
+            # another process is starting the daemon
+            time.sleep(0.1)
+            continue
+        _lock = lock
+        return False
+
+    logger.warning("daemon: not reachable, running standalone")
+    return False
+
+
+def is_daemon() -> bool:
+    return _lock is not None
+
+
+class Daemon:
+    def __init__(self) -> None:
+        from bgm.utils import AsyncWorker
+
+        self.worker = AsyncWorker()
+        self.players: dict[str, "MPVBangumi"] = {}
+        self.attaching = 0
+        self.cond = threading.Condition()
+        self.closing = False
+
+    def add_player(self, ipc_socket: str):
+        from python_mpv_jsonipc import MPV
+
+        from bgm.mpvbangumi import MPVBangumi
+
+        mpv = MPV(
+            start_mpv=False,
+            ipc_socket=ipc_socket,
+            quit_callback=lambda *_: self.remove_player(ipc_socket),
+        )
+        player = MPVBangumi(mpv, worker=self.worker)
+        mpv.bind_property_observer(PROPERTY_DISPATCH, player.dispatch)
+        with self.cond:
+            self.players[ipc_socket] = player
+        player.resp_message("ready", {"ok": True})
+        logger.debug("daemon: attached %s, %d players", ipc_socket, len(self.players))
+
+    def remove_player(self, ipc_socket: str):
+        with self.cond:
+            player = self.players.pop(ipc_socket, None)
+            self.cond.notify_all()
+        if player is not None:
+            player.close()
+        logger.debug("daemon: detached %s", ipc_socket)
+
+    def accept_loop(self, listener: Listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception:
+                if self.closing:
+                    return
+                continue
+            with conn:
+                with self.cond:
+                    accepted = not self.closing
+                    self.attaching += accepted
+                try:
+                    ipc_socket = conn.recv()
+                    if accepted:
+                        self.add_player(ipc_socket)
+                    conn.send(accepted)
+                except Exception as e:
+                    logger.warning("daemon: failed to attach player: %r", e)
+                finally:
+                    with self.cond:
+                        self.attaching -= accepted
+                        self.cond.notify_all()
+
+    def _busy(self) -> bool:
+        return bool(self.players) or self.attaching > 0
+
+    def wait_idle(self):
+        with self.cond:
+            while True:
+                self.cond.wait_for(lambda: not self._busy())
+                if not self.cond.wait_for(self._busy, IDLE_TIMEOUT):
+                    self.closing = True
+                    return
+
+    def serve(self, ipc_socket: str):
+        from bgm.mpvbangumi import shutdown_worker
+
+        if sys.platform != "win32" and os.path.exists(ADDRESS):
+            os.unlink(ADDRESS)  # left by a daemon that did not exit cleanly
+        listener = Listener(ADDRESS, authkey=_authkey())
+        try:
+            self.add_player(ipc_socket)
+            threading.Thread(
+                target=self.accept_loop, args=(listener,), daemon=True
+            ).start()
+            self.wait_idle()
+            logger.debug("daemon: idle, exiting")
+        finally:
+            listener.close()
+            shutdown_worker(self.worker)
+            assert _lock is not None
+            _lock.release()
@@ -1,17 +1,15 @@
 #!/bin/python
+import asyncio
 import base64
 import contextlib
-from dataclasses import dataclass
 import hashlib
 import json
-import mimetypes
 import os
 from pathlib import Path
 import time
 from typing import TYPE_CHECKING, Any, List, Literal, NoReturn
 
 import aiohttp
-from pymediainfo import MediaInfo
 
 from bgm import DATA_PATH
 from bgm import logger
@@ -20,8 +18,9 @@ from bgm.danmaku import (
     convert_dandanplay_json2danmaku_events,
     get_style_config,
 )
-from bgm.db import EpisodeMatch, db
-from bgm.utils import extract_info_from_filename
+from bgm.db import CacheWriter, EpisodeMatch, db
+from bgm.media import VideoInfo, check_video, probe_video
+from bgm.filename import extract_info_from_filename
 from bgm.api import API
 
 if TYPE_CHECKING:
@@ -33,6 +32,14 @@ AUTHENTICATION_TOKEN_PATH = DATA_PATH / "authentication_token.json"
 AUTHENTICATION_TOKEN: str | None = None
 AUTHENTICATION_TOKEN_TIMESTAMP: int | None = None
 
+# max number of files per /match/batch request
+BATCH_MATCH_SIZE = 32
+# unmatched videos are batch matched again once this old, dandanplay keeps growing
+BATCH_UNMATCHED_MAX_AGE = 7 * 24 * 3600
+
+# one batch match at a time, a later one finds the results of the previous
+_batch_lock = asyncio.Lock()
+
 def load_authentication_token():
     global AUTHENTICATION_TOKEN, AUTHENTICATION_TOKEN_TIMESTAMP
     if AUTHENTICATION_TOKEN_PATH.exists():
@@ -45,57 +52,6 @@ def load_authentication_token():
                 logger.error("Failed to load authentication token from file.")
 
 
-# video utils >>> -------------------------------------------------------------
-
-
-@dataclass
-class VideoInfo:
-    hash: str
-    duration: int
-    filename: str
-    size: int
-    resolution: tuple[int, int]
-
-
-def check_video(file_path: Path) -> bool:
-    if not file_path.exists():
-        return False
-    try:
-        guess = mimetypes.guess_type(file_path)[0]
-        return guess.startswith("video") if guess is not None else False
-    except FileNotFoundError:
-        return False
-
-
-def get_hash(video_path: Path) -> str:
-    assert video_path.exists()
-    with open(video_path, "rb") as f:
-        # 16 * 1024 * 1024 = 16777216
-        return hashlib.md5(f.read(16777216)).hexdigest().upper()
-
-
-def get_duration(video_path: Path) -> int:
-    """path must exist"""
-    info = MediaInfo.parse(video_path)
-    return int(float(info.video_tracks[0].duration) / 1000)  # type: ignore
-
-
-def get_resolution(video_path: Path) -> tuple[int, int]:
-    info = MediaInfo.parse(video_path)
-    return (info.video_tracks[0].width, info.video_tracks[0].height)  # type: ignore
-
-
-def get_info(video_path: Path):
-    """path must exist"""
-    return VideoInfo(
-        hash=get_hash(video_path),
-        duration=get_duration(video_path),
-        filename=video_path.stem,
-        size=Path(video_path).stat().st_size,
-        resolution=get_resolution(video_path),
-    )
-
-
 # api >>> ---------------------------------------------------------------------
 
 class DanDanAPI(API):
@@ -139,7 +95,9 @@ class DanDanAPI(API):
 
         return await self._request("POST", self.API_BASE + uri, json=data or {}, headers=dynamic_headers)
 
-    async def get(self, uri: str, params: dict | None = None) -> Any:
+    async def get(
+        self, uri: str, params: dict | None = None, cache: CacheWriter | None = None
+    ) -> Any:
         timestamp = int(time.time())
         path = "/api/v2/" + uri
         sig = self.generate_signature(timestamp, path)
@@ -151,16 +109,20 @@ class DanDanAPI(API):
             "X-Timestamp": str(timestamp),
         } | self.auth_header
 
-        return await self._request("GET", self.API_BASE + uri, params=params or {}, headers=dynamic_headers)
+        return await self._request("GET", self.API_BASE + uri, cache=cache, params=params or {}, headers=dynamic_headers)
 
-    async def match(self, video_info: VideoInfo) -> List[EpisodeMatch]:
-        data = {
+    @staticmethod
+    def _match_request(video_info: VideoInfo) -> dict:
+        return {
             "fileName": video_info.filename,
             "fileHash": video_info.hash,
             "fileSize": video_info.size,
             "videoDuration": video_info.duration,
             "matchMode": "hashAndFileName",
         }
+
+    async def match(self, video_info: VideoInfo) -> List[EpisodeMatch]:
+        data = self._match_request(video_info)
         logger.debug("match data: %s", data)
         j = await self.post("match", data)
         logger.debug("match: %s", j)
@@ -168,8 +130,32 @@ class DanDanAPI(API):
         episodes = [EpisodeMatch.model_validate(info) for info in j["matches"]]
         return episodes
 
+    async def batch_match(
+        self, video_infos: list[VideoInfo]
+    ) -> list[List[EpisodeMatch]]:
+        """match up to BATCH_MATCH_SIZE videos in one request, only exact matches are returned"""
+        assert len(video_infos) <= BATCH_MATCH_SIZE
+        j = await self.post(
+            "match/batch",
+            {"requests": [self._match_request(info) for info in video_infos]},
+        )
+        logger.debug("batch match: %s", j)
+        assert j["success"]
+        by_hash = {
+            result["fileHash"]: [
+                EpisodeMatch.model_validate(info) for info in result.get("matches") or []
+            ]
+            for result in j["results"]
+            if result.get("success") and result.get("isMatched")
+        }
+        return [by_hash.get(info.hash, []) for info in video_infos]
+
     async def get_comment(
-        self, episode_id: int, related: bool, convert: Literal["no", "chs", "cht"]
+        self,
+        episode_id: int,
+        related: bool,
+        convert: Literal["no", "chs", "cht"],
+        cache: CacheWriter | None = None,
     ):
         chConvert = {"no": 0, "chs": 1, "cht": 2}[convert]
         withRelated = "true" if related else "false"
@@ -180,6 +166,7 @@ class DanDanAPI(API):
                 "withRelated": withRelated,
                 "chConvert": chConvert,
             },
+            cache=cache,
         )
         return j
 
@@ -216,8 +203,11 @@ class DanDanAPI(API):
         j = await self.post(f"comment/{episode_id}", data)
         return j
 
-    async def get_anime_info(self, anime_id: int):
-        j = await self.get(f"bangumi/{anime_id}")
+    async def get_anime_info(self, anime_id: int, cache: CacheWriter | None = None):
+        """None if failed or not modified (check `cache.not_modified`)"""
+        j = await self.get(f"bangumi/{anime_id}", cache=cache)
+        if j is None:
+            return
         if not j["success"]:
             logger.error("Failed to get anime info: %s", j["errorMessage"])
             return
@@ -246,7 +236,7 @@ async def get_match_info(
         logger.error(f"Not a video file: {video_path}")
         return
 
-    info = get_info(video_path)
+    info = await probe_video(video_path)
     async with DanDanAPI() as api:
         match_results: list[EpisodeMatch] = (await api.match(info))
     if not match_results:
@@ -258,16 +248,89 @@ async def get_match_info(
     return match_results
 
 
+def collect_batch_candidates(video: Path, playlist: list[str] | None) -> list[Path]:
+    """unmatched videos other than `video` from the mpv playlist, or from the
+    video's directory if there is no playlist"""
+    paths = [Path(p).absolute() for p in playlist or []]
+    if len(paths) <= 1:
+        paths = sorted(video.parent.iterdir())
+
+    candidates = []
+    for path in paths:
+        if path == video:
+            continue
+        if not any(path.is_relative_to(storage) for storage in config.storages):
+            continue
+        if not check_video(path):
+            continue
+        res = db.get(path=str(path))
+        if res is not None and res.dandanplay_id is not None:
+            continue
+        stat = path.stat()
+        if db.is_batch_unmatched(
+            str(path), stat.st_size, stat.st_mtime_ns, BATCH_UNMATCHED_MAX_AGE
+        ):
+            continue
+        candidates.append(path)
+    return candidates
+
+
+async def batch_match_videos(video: Path, playlist: list[str] | None = None) -> None:
+    """Match the unmatched videos alongside `video` with batched requests, results are saved to db."""
+    async with _batch_lock:
+        await _batch_match_videos(video, playlist)
+
+
+async def _batch_match_videos(video: Path, playlist: list[str] | None) -> None:
+    candidates = collect_batch_candidates(video, playlist)
+    if not candidates:
+        return
+
+    results = await asyncio.gather(
+        *(probe_video(path) for path in candidates), return_exceptions=True
+    )
+    infos: list[tuple[Path, VideoInfo]] = []
+    for path, result in zip(candidates, results):
+        if isinstance(result, BaseException):
+            logger.warning("Failed to probe %s: %s", path.name, result)
+            continue
+        infos.append((path, result))
+
+    logger.info("batch match: %d videos", len(infos))
+    matched = 0
+    unmatched: list[tuple[str, int, int]] = []
+    async with DanDanAPI() as api:
+        for start in range(0, len(infos), BATCH_MATCH_SIZE):
+            batch = infos[start : start + BATCH_MATCH_SIZE]
+            try:
+                batch_results = await api.batch_match([info for _, info in batch])
+            except Exception as e:
+                logger.warning("batch match failed: %s", e)
+                continue
+            for (path, info), matches in zip(batch, batch_results):
+                # ambiguous results are left for the single match and select-match
+                if len(matches) != 1:
+                    unmatched.append((str(path), info.size, path.stat().st_mtime_ns))
+                    continue
+                episode_info = matches[0]
+                db.set_dandanplay_id(str(path), episode_info.episodeId)
+                db.set_episode_info(episode_info.episodeId, episode_info)
+                matched += 1
+    db.set_batch_unmatched(unmatched)
+    logger.info("batch match: %d/%d videos matched", matched, len(infos))
+
+
 async def construct_episode_match(episode_id: int) -> EpisodeMatch | None:
     """Construct an EpisodeMatch object from anime info."""
     info_path = db.get_path(episode_id, "info")
     async with db.check_update_async(info_path) as writer:
         if writer:
             async with DanDanAPI() as api:
-                info = await api.get_anime_info(episode_id // 10000)
-                if info is None:
+                info = await api.get_anime_info(episode_id // 10000, cache=writer)
+                if info is not None:
+                    writer(json.dumps(info))
+                elif not writer.not_modified:
                     return
-                writer(json.dumps(info))
     anime_info = json.loads(info_path.read_text(encoding="utf-8"))
     try:
         episode_part = (
@@ -312,7 +375,12 @@ async def api_match_danmaku(ctx: 'MPVBangumi', video: Path):
 
     return episode_info
 
-async def match_video(ctx: 'MPVBangumi', video: Path, force_id: int | None = None) -> None:
+async def match_video(
+    ctx: "MPVBangumi",
+    video: Path,
+    force_id: int | None = None,
+    playlist: list[str] | None = None,
+) -> None:
     """Match dandanplay epsisode info for a video file."""
     video = video.absolute()
     if not any(video.is_relative_to(storage) for storage in config.storages):
@@ -362,8 +430,10 @@ async def match_video(ctx: 'MPVBangumi', video: Path, force_id: int | None = Non
             db.set_episode_info(episode_id, episode_info)
         db.set_dandanplay_id(str(video), episode_info.episodeId)
     else:
-        # match video to dandanplay episode
+        # match video to dandanplay episode, the other unmatched videos of the
+        # directory (or playlist) are batch matched afterwards in the background
         episode_info = await api_match_danmaku(ctx, video)
+        ctx.add_task(batch_match_videos(video, playlist), bound=False)
         if episode_info is None:
             return
         episode_id = episode_info.episodeId
@@ -395,12 +465,11 @@ async def fetch_danmaku(ctx: "MPVBangumi", episode_id: int):
     async with db.check_update_async(comment_path) as writer:
         if writer is not None:
             async with DanDanAPI() as api:
-                writer(
-                    json.dumps(
-                        (await api.get_comment(episode_id, related=True, convert="no")),
-                        ensure_ascii=True,
-                    )
+                comment = await api.get_comment(
+                    episode_id, related=True, convert="no", cache=writer
                 )
+                if comment is not None:
+                    writer(json.dumps(comment, ensure_ascii=True))
     comments = json.loads(comment_path.read_text(encoding="utf-8"))["comments"]
     ctx.update_comments("main", comments)
 
@@ -411,10 +480,11 @@ async def get_bgm_id(video: Path, anime_id: int):
     async with db.check_update_async(info_path, 3600 * 24) as writer:
         if writer is not None:
             async with DanDanAPI() as api:
-                info = await api.get_anime_info(anime_id)
-                if info is None:
+                info = await api.get_anime_info(anime_id, cache=writer)
+                if info is not None:
+                    writer(json.dumps(info, ensure_ascii=True))
+                elif not writer.not_modified:
                     return
-                writer(json.dumps(info, ensure_ascii=True))
 
     info = json.loads(info_path.read_text(encoding="utf-8"))
 
@@ -535,10 +605,11 @@ async def dandanplay_get_episodes(ctx: "MPVBangumi", anime_id: int):
     async with db.check_update_async(info_path) as writer:
         if writer:
             async with DanDanAPI() as api:
-                info = await api.get_anime_info(anime_id)
-                if info is None:
+                info = await api.get_anime_info(anime_id, cache=writer)
+                if info is not None:
+                    writer(json.dumps(info))
+                elif not writer.not_modified:
                     return
-                writer(json.dumps(info))
 
     episodes = json.loads(info_path.read_text(encoding="utf-8"))["episodes"]
     ctx.resp_message(
@@ -1,4 +1,6 @@
+from concurrent.futures import ProcessPoolExecutor
 import json
+import multiprocessing
 from pathlib import Path
 from typing import Literal
 from bgm.config import config
@@ -375,3 +377,42 @@ def get_style_config():
         scrolltime=config.danmaku.scrolltime,
         fixtime=config.danmaku.fixtime,
     )
+
+
+def layout_payload(sources: list[str], comments: list[dict]) -> str:
+    """lay out the danmaku and encode the set-danmaku data, runs in the layout process"""
+    events = convert_dandanplay_json2danmaku_events(comments)
+    return json.dumps(
+        {
+            "sources": sources,
+            "events": [e.model_dump() for e in events],
+            "style": get_style_config(),
+        },
+        ensure_ascii=True,
+    )
+
+
+_layout_pool: ProcessPoolExecutor | None = None
+
+
+def get_layout_pool() -> ProcessPoolExecutor:
+    """a persistent process, started once and kept warm between episodes"""
+    global _layout_pool
+    if _layout_pool is None:
+        # spawn: forking a process that runs threads is unsafe
+        _layout_pool = ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _layout_pool
+
+
+def warmup_layout_pool():
+    """start the layout process now, it imports this module before the first layout"""
+    get_layout_pool().submit(get_style_config)
+
+
+def shutdown_layout_pool():
+    global _layout_pool
+    if _layout_pool is not None:
+        _layout_pool.shutdown(wait=False, cancel_futures=True)
+        _layout_pool = None
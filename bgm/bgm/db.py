@@ -1,6 +1,9 @@
+import asyncio
+from collections import defaultdict
 import contextlib
+import os
 import sqlite3
-from typing import Any, Callable, Literal, NamedTuple, TypedDict, Unpack, NotRequired
+from typing import Any, Callable, Literal, Mapping, NamedTuple, TypedDict, Unpack, NotRequired
 from bgm import DATA_PATH
 from pydantic import BaseModel
 import json
@@ -8,9 +11,9 @@ import datetime
 from bgm import logger
 from pathlib import Path
 import portalocker
-from collections import Counter
+import threading
 
-from bgm.utils import extract_info_from_filename
+from bgm.filename import extract_info_from_filename
 
 
 class EpisodeMatch(BaseModel):
@@ -35,6 +38,59 @@ class IDS(NamedTuple):
     dandanplay_id: int | None
 
 
+class SyncItem(NamedTuple):
+    id: int
+    kind: Literal["collection", "episode"]
+    subject_id: int
+    target_id: int
+    status: int
+    note: str | None
+    attempts: int
+
+
+class ProbeResult(NamedTuple):
+    hash: str
+    duration: int
+    width: int
+    height: int
+
+
+class CacheWriter:
+    """Write callback yielded by `DB.check_update`.
+
+    It also carries the HTTP validators of the cached resource, so that a
+    refresh can be a conditional request and a 304 only bumps the mtime.
+    """
+
+    def __init__(self, db: "DB", path: Path, f: Any):
+        self.db = db
+        self.path = path
+        self.f = f
+        self.not_modified = False
+        self._validators: tuple[str | None, str | None] = (None, None)
+
+    def __call__(self, content: str):
+        self.f.seek(0)
+        self.f.write(content.encode("utf-8"))
+        self.f.truncate()
+        self.f.flush()
+        self.db.set_validators(self.path, *self._validators)
+
+    @property
+    def conditional_headers(self) -> dict[str, str]:
+        if self.path.stat().st_size == 0:
+            return {}
+        return self.db.get_validators(self.path)
+
+    def set_validators(self, headers: Mapping[str, str]):
+        """remember the validators of a fresh response, saved on write"""
+        self._validators = (headers.get("ETag"), headers.get("Last-Modified"))
+
+    def set_not_modified(self):
+        self.not_modified = True
+        os.utime(self.path)
+
+
 class DB:
     TABLE_NAME = "bgm"
 
@@ -45,6 +101,8 @@ class DB:
         self.conn = sqlite3.connect(self.db_path, check_same_thread=False, autocommit=True)
         self.conn.execute("PRAGMA journal_mode=WAL;")
         self.cursor = self.conn.cursor()
+        self.lock = threading.RLock()
+        self._update_locks: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
         self.create_table()
 
     def __del__(self):
@@ -58,11 +116,180 @@ class DB:
             CREATE TABLE IF NOT EXISTS {self.TABLE_NAME} (
                 path TEXT PRIMARY KEY,
                 bgm_id INTEGER,
-                dandanplay_id INTEGER
+                dandanplay_id INTEGER,
+                parent_dir TEXT,
+                episode INTEGER
+            )
+            """
+        )
+        # per directory histogram of (anime_id, ep_offset), used by autoload
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS autoload (
+                parent_dir TEXT,
+                anime_id INTEGER,
+                ep_offset INTEGER,
+                count INTEGER,
+                PRIMARY KEY (parent_dir, anime_id, ep_offset)
+            )
+            """
+        )
+        self.migrate_autoload()
+        self.cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS {self.TABLE_NAME}_parent_dir "
+            f"ON {self.TABLE_NAME} (parent_dir)"
+        )
+        # pending bangumi.tv writes, flushed in batches by bangumi_flush_outbox
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT,
+                subject_id INTEGER,
+                target_id INTEGER,
+                status INTEGER,
+                note TEXT,
+                attempts INTEGER DEFAULT 0,
+                UNIQUE (kind, target_id)
+            )
+            """
+        )
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bangumi_episode (
+                episode_id INTEGER PRIMARY KEY,
+                subject_id INTEGER,
+                status INTEGER
+            )
+            """
+        )
+        # bangumi-data items keyed by content hash, and their (site, id) index
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bangumi_data_item (
+                hash TEXT PRIMARY KEY,
+                title TEXT,
+                item TEXT
+            )
+            """
+        )
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bangumi_data_site (
+                site TEXT,
+                site_id TEXT,
+                hash TEXT,
+                PRIMARY KEY (site, site_id, hash)
+            )
+            """
+        )
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS bangumi_data_site_hash ON bangumi_data_site (hash)"
+        )
+        # mirror of the user's bangumi.tv collection, see bangumi_refresh_collections
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bangumi_collection (
+                subject_id INTEGER PRIMARY KEY,
+                status INTEGER
+            )
+            """
+        )
+        # videos the batch match found nothing for, skipped until they change or expire
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS batch_unmatched (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime INTEGER,
+                checked_at INTEGER
+            )
+            """
+        )
+        # LLM translations of normalized danmaku text, shared by every video
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS translation_memory (
+                model TEXT,
+                source TEXT,
+                translation TEXT,
+                PRIMARY KEY (model, source)
+            )
+            """
+        )
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS http_cache (
+                path TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT
+            )
+            """
+        )
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS media (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime INTEGER,
+                hash TEXT,
+                duration INTEGER,
+                width INTEGER,
+                height INTEGER
             )
             """
         )
 
+    def migrate_autoload(self):
+        """add parent_dir/episode columns to old databases and build the autoload table"""
+        self.cursor.execute(f"PRAGMA table_info({self.TABLE_NAME})")
+        columns = {row[1] for row in self.cursor.fetchall()}
+        if "parent_dir" in columns:
+            return
+        logger.info("db: migrating %s table for autoload", self.TABLE_NAME)
+        with self.transaction():
+            self.cursor.execute(f"ALTER TABLE {self.TABLE_NAME} ADD COLUMN parent_dir TEXT")
+            self.cursor.execute(f"ALTER TABLE {self.TABLE_NAME} ADD COLUMN episode INTEGER")
+            self.cursor.execute(f"SELECT path, dandanplay_id FROM {self.TABLE_NAME}")
+            for path, dandanplay_id in self.cursor.fetchall():
+                parent_dir, episode = self._path_info(path)
+                self.cursor.execute(
+                    f"UPDATE {self.TABLE_NAME} SET parent_dir = ?, episode = ? WHERE path = ?",
+                    (parent_dir, episode, path),
+                )
+                if dandanplay_id is not None:
+                    self._update_autoload(parent_dir, dandanplay_id, episode, 1)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.cursor.execute("ROLLBACK")
+                raise
+            self.cursor.execute("COMMIT")
+
+    @staticmethod
+    def _path_info(path: str) -> tuple[str, int | None]:
+        """parent_dir and parsed episode number of a video path"""
+        path_ = Path(path)
+        return str(path_.parent), extract_info_from_filename(path_.name).episode
+
+    def _update_autoload(
+        self, parent_dir: str, dandanplay_id: int, episode: int | None, delta: int
+    ):
+        anime_id = dandanplay_id // 10000
+        ep_offset = dandanplay_id % 10000 - (episode or 0)
+        self.cursor.execute(
+            "INSERT INTO autoload (parent_dir, anime_id, ep_offset, count) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(parent_dir, anime_id, ep_offset) DO UPDATE SET count = count + ?",
+            (parent_dir, anime_id, ep_offset, delta, delta),
+        )
+        if delta < 0:
+            self.cursor.execute("DELETE FROM autoload WHERE count <= 0")
+
     def get(self, **query: Unpack[QueryDict]):
         query_str = " AND ".join(f"{k}=?" for k in query.keys())
         sql = f"SELECT path, bgm_id, dandanplay_id FROM {self.TABLE_NAME} WHERE {query_str}"
@@ -74,23 +301,16 @@ class DB:
 
     def get_autoload_source(self, dir_: str, filename: str) -> int | None:
         self.cursor.execute(
-            f"SELECT path, dandanplay_id FROM {self.TABLE_NAME} WHERE path like ? and dandanplay_id IS NOT NULL",
-            (dir_ + "%",),
+            "SELECT anime_id, ep_offset FROM autoload WHERE parent_dir = ? "
+            "ORDER BY count DESC, anime_id, ep_offset",
+            (dir_,),
         )
         results = self.cursor.fetchall()
-        filenames = [Path(r[0]).name for r in results]
-        episode_ids = [r[1] for r in results]
-        animes = set([r // 10000 for r in episode_ids])
+        animes = set([r[0] for r in results])
         if len(animes) != 1:
             return None
-        anime_id = animes.pop()
+        anime_id, offset = results[0]
         ep = extract_info_from_filename(filename).episode
-        offset = Counter(
-            [
-                epid % 10000 - (extract_info_from_filename(name).episode or 0)
-                for epid, name in zip(episode_ids, filenames)
-            ]
-        ).most_common(1)[0][0]
         if offset != 0:
             logger.info("autoload: use offset %d", offset)
         if not ep:
@@ -98,17 +318,196 @@ class DB:
         return anime_id * 10000 + ep + offset
 
     def set_bgm_id(self, path: str, id_: int):
+        parent_dir, episode = self._path_info(path)
         self.cursor.execute(
-            f"INSERT INTO {self.TABLE_NAME} (path, bgm_id) VALUES (?, ?) "
+            f"INSERT INTO {self.TABLE_NAME} (path, bgm_id, parent_dir, episode) VALUES (?, ?, ?, ?) "
             "ON CONFLICT(path) DO UPDATE SET bgm_id = ?",
-            (path, id_, id_),
+            (path, id_, parent_dir, episode, id_),
         )
 
     def set_dandanplay_id(self, path: str, id_: int):
+        parent_dir, episode = self._path_info(path)
+        with self.transaction():
+            self.cursor.execute(
+                f"SELECT dandanplay_id, parent_dir, episode FROM {self.TABLE_NAME} WHERE path = ?",
+                (path,),
+            )
+            prev = self.cursor.fetchone()
+            prev_id = prev[0] if prev else None
+            if prev_id == id_:
+                return
+            self.cursor.execute(
+                f"INSERT INTO {self.TABLE_NAME} (path, dandanplay_id, parent_dir, episode) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET dandanplay_id = ?, parent_dir = ?, episode = ?",
+                (path, id_, parent_dir, episode, id_, parent_dir, episode),
+            )
+            if prev_id is not None:
+                # undo exactly what was counted, the parser may have changed since
+                self._update_autoload(prev[1], prev_id, prev[2], -1)
+            self._update_autoload(parent_dir, id_, episode, 1)
+
+    def enqueue_sync(
+        self,
+        kind: Literal["collection", "episode"],
+        subject_id: int,
+        target_id: int,
+        status: int,
+        note: str | None = None,
+    ):
+        """a newer update of the same target replaces the pending one"""
         self.cursor.execute(
-            f"INSERT INTO {self.TABLE_NAME} (path, dandanplay_id) VALUES (?, ?) "
-            "ON CONFLICT(path) DO UPDATE SET dandanplay_id = ?",
-            (path, id_, id_),
+            "INSERT OR REPLACE INTO outbox (kind, subject_id, target_id, status, note) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (kind, subject_id, target_id, status, note),
+        )
+
+    def get_pending_sync(self) -> list[SyncItem]:
+        self.cursor.execute(
+            "SELECT id, kind, subject_id, target_id, status, note, attempts FROM outbox ORDER BY id"
+        )
+        return [SyncItem(*r) for r in self.cursor.fetchall()]
+
+    def finish_sync(self, items: list[SyncItem]):
+        self.cursor.executemany(
+            "DELETE FROM outbox WHERE id=?", [(item.id,) for item in items]
+        )
+
+    def fail_sync(self, items: list[SyncItem]):
+        self.cursor.executemany(
+            "UPDATE outbox SET attempts = attempts + 1 WHERE id=?",
+            [(item.id,) for item in items],
+        )
+
+    def get_episode_status(self, episode_id: int) -> int | None:
+        self.cursor.execute(
+            "SELECT status FROM bangumi_episode WHERE episode_id=?", (episode_id,)
+        )
+        result = self.cursor.fetchone()
+        return result[0] if result else None
+
+    def set_episode_status(self, subject_id: int, episode_ids: list[int], status: int):
+        self.cursor.executemany(
+            "INSERT OR REPLACE INTO bangumi_episode (episode_id, subject_id, status) VALUES (?, ?, ?)",
+            [(episode_id, subject_id, status) for episode_id in episode_ids],
+        )
+
+    def get_collection_status(self, subject_id: int) -> int | None:
+        self.cursor.execute(
+            "SELECT status FROM bangumi_collection WHERE subject_id=?", (subject_id,)
+        )
+        result = self.cursor.fetchone()
+        return result[0] if result else None
+
+    def set_collection_status(self, subject_id: int, status: int):
+        self.cursor.execute(
+            "INSERT OR REPLACE INTO bangumi_collection (subject_id, status) VALUES (?, ?)",
+            (subject_id, status),
+        )
+
+    def replace_collections(self, statuses: Mapping[int, int]):
+        with self.transaction():
+            self.cursor.execute("DELETE FROM bangumi_collection")
+            self.cursor.executemany(
+                "INSERT INTO bangumi_collection (subject_id, status) VALUES (?, ?)",
+                statuses.items(),
+            )
+
+    def has_bangumi_data(self) -> bool:
+        self.cursor.execute("SELECT 1 FROM bangumi_data_item LIMIT 1")
+        return self.cursor.fetchone() is not None
+
+    def get_bangumi_data_hashes(self) -> set[str]:
+        self.cursor.execute("SELECT hash FROM bangumi_data_item")
+        return {r[0] for r in self.cursor.fetchall()}
+
+    def update_bangumi_data(self, added: Mapping[str, dict], removed: set[str]):
+        with self.transaction():
+            self.cursor.executemany(
+                "DELETE FROM bangumi_data_item WHERE hash=?", [(h,) for h in removed]
+            )
+            self.cursor.executemany(
+                "DELETE FROM bangumi_data_site WHERE hash=?", [(h,) for h in removed]
+            )
+            self.cursor.executemany(
+                "INSERT OR REPLACE INTO bangumi_data_item (hash, title, item) VALUES (?, ?, ?)",
+                [
+                    (h, item["title"], json.dumps(item, ensure_ascii=False))
+                    for h, item in added.items()
+                ],
+            )
+            self.cursor.executemany(
+                "INSERT OR REPLACE INTO bangumi_data_site (site, site_id, hash) VALUES (?, ?, ?)",
+                [
+                    (site["site"], str(site["id"]), h)
+                    for h, item in added.items()
+                    for site in item["sites"]
+                    if "id" in site
+                ],
+            )
+
+    def find_bangumi_data(self, site: str, site_id: str) -> dict | None:
+        """several items may share a site id, the one that began last wins"""
+        self.cursor.execute(
+            "SELECT i.item FROM bangumi_data_site s JOIN bangumi_data_item i ON s.hash = i.hash "
+            "WHERE s.site=? AND s.site_id=? "
+            "ORDER BY json_extract(i.item, '$.begin') DESC, s.hash LIMIT 1",
+            (site, site_id),
+        )
+        result = self.cursor.fetchone()
+        return json.loads(result[0]) if result else None
+
+    def is_batch_unmatched(self, path: str, size: int, mtime: int, max_age: int) -> bool:
+        self.cursor.execute(
+            "SELECT 1 FROM batch_unmatched WHERE path=? AND size=? AND mtime=? AND checked_at>?",
+            (path, size, mtime, int(datetime.datetime.now().timestamp()) - max_age),
+        )
+        return self.cursor.fetchone() is not None
+
+    def set_batch_unmatched(self, videos: list[tuple[str, int, int]]):
+        """(path, size, mtime) of videos the batch match found nothing for"""
+        now = int(datetime.datetime.now().timestamp())
+        self.cursor.executemany(
+            "INSERT OR REPLACE INTO batch_unmatched (path, size, mtime, checked_at) VALUES (?, ?, ?, ?)",
+            [(*video, now) for video in videos],
+        )
+
+    def get_translations(self, model: str, sources: list[str]) -> dict[str, str]:
+        """translation memory hits among `sources`"""
+        result: dict[str, str] = {}
+        with self.lock:
+            # stay below SQLITE_MAX_VARIABLE_NUMBER of old sqlite builds
+            for start in range(0, len(sources), 500):
+                batch = sources[start : start + 500]
+                self.cursor.execute(
+                    "SELECT source, translation FROM translation_memory "
+                    f"WHERE model=? AND source IN ({','.join('?' * len(batch))})",
+                    (model, *batch),
+                )
+                result.update(self.cursor.fetchall())
+        return result
+
+    def set_translations(self, model: str, translations: Mapping[str, str]):
+        self.cursor.executemany(
+            "INSERT OR REPLACE INTO translation_memory (model, source, translation) VALUES (?, ?, ?)",
+            [(model, source, trans) for source, trans in translations.items()],
+        )
+
+    def get_probe_result(self, path: str, size: int, mtime: int) -> ProbeResult | None:
+        """cached probe result, only valid if the file is unchanged"""
+        self.cursor.execute(
+            "SELECT hash, duration, width, height FROM media WHERE path=? AND size=? AND mtime=?",
+            (path, size, mtime),
+        )
+        result = self.cursor.fetchone()
+        if result:
+            return ProbeResult(*result)
+        return None
+
+    def set_probe_result(self, path: str, size: int, mtime: int, result: ProbeResult):
+        self.cursor.execute(
+            "INSERT OR REPLACE INTO media (path, size, mtime, hash, duration, width, height) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (path, size, mtime, *result),
         )
 
     def get_episode_info(self, episode_id: int):
@@ -174,7 +573,9 @@ class DB:
     def get_path(
         self,
         episode_id: int,
-        type_: Literal["comment", "ass", "metadata", "info", "episodes", "source", "commentEX"],
+        type_: Literal[
+            "comment", "ass", "metadata", "info", "episodes", "episodes-index", "source", "commentEX"
+        ],
     ):
         path = self.metadata_path / f"{episode_id // 10000}"
         if type_ == "comment":  # 单集字幕(json)
@@ -187,6 +588,8 @@ class DB:
             path /= f"{episode_id}.json"
         elif type_ == "episodes":  # 番剧信息(bangumi.tv)
             path /= "episodes.json"
+        elif type_ == "episodes-index":  # 剧集标题索引(bangumi.tv)
+            path /= "episodes-index.json"
         elif type_ == "source":  # 第三方弹幕源信息(current niconico only)
             path /= "source.json"
         elif type_ == "commentEX":  # 第三方弹幕源的弹幕
@@ -201,21 +604,15 @@ class DB:
             yield None
             return
 
-        path.touch(exist_ok=True)
-        with portalocker.Lock(
-            path, mode="r+b", flags=portalocker.LockFlags.EXCLUSIVE
-        ) as f:
-            if not self.is_outdated(path, max_age):
-                yield None
-                return
-
-            def safe_write(content: str):
-                f.seek(0)
-                f.write(content.encode("utf-8"))
-                f.truncate()
-                f.flush()
+        # coroutines of this process wait here instead of blocking the loop on the file lock,
+        # and usually find the file already updated by the first one
+        async with self.update_lock(path):
+            with self.check_update(path, max_age) as writer:
+                yield writer
 
-            yield safe_write
+    def update_lock(self, path: Path) -> asyncio.Lock:
+        """in-process lock to take before a file lock held across awaits"""
+        return self._update_locks[str(path)]
 
     @contextlib.contextmanager
     def check_update(self, path: Path, max_age: int = 3600 * 4):
@@ -223,7 +620,9 @@ class DB:
             yield None
             return
 
-        path.touch(exist_ok=True)
+        # touching an existing file would refresh its mtime
+        if not path.exists():
+            path.touch()
         with portalocker.Lock(
             path, mode="r+b", flags=portalocker.LockFlags.EXCLUSIVE
         ) as f:
@@ -231,13 +630,31 @@ class DB:
                 yield None
                 return
 
-            def safe_write(content: str):
-                f.seek(0)
-                f.write(content.encode("utf-8"))
-                f.truncate()
-                f.flush()
+            yield CacheWriter(self, path, f)
 
-            yield safe_write
+    def get_validators(self, path: Path) -> dict[str, str]:
+        self.cursor.execute(
+            "SELECT etag, last_modified FROM http_cache WHERE path=?", (str(path),)
+        )
+        result = self.cursor.fetchone()
+        if not result:
+            return {}
+        etag, last_modified = result
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def set_validators(self, path: Path, etag: str | None, last_modified: str | None):
+        if not (etag or last_modified):
+            self.cursor.execute("DELETE FROM http_cache WHERE path=?", (str(path),))
+            return
+        self.cursor.execute(
+            "INSERT OR REPLACE INTO http_cache (path, etag, last_modified) VALUES (?, ?, ?)",
+            (str(path), etag, last_modified),
+        )
 
     def get_or_update(
         self,
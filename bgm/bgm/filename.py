@@ -0,0 +1,87 @@
+from functools import lru_cache
+import re
+from typing import Iterable
+
+from pydantic import BaseModel, ConfigDict
+
+
+class InfoFromFileName(BaseModel):
+    # instances are shared through the lru cache
+    model_config = ConfigDict(frozen=True)
+
+    title: str | None
+    tags: tuple[str, ...]
+    episode: int | None
+
+
+TAGS_RE = re.compile(r"[\[\(（【第](.+?)[\]\)）】话話]")
+
+# rules are tried in order, the first match wins
+TAG_EPISODE_RULES = (
+    re.compile(r"^(\d+)(v\d|end)?$", re.IGNORECASE).match,
+    re.compile(r"^ep_?(\d+).*$", re.IGNORECASE).match,
+)
+PART_EPISODE_RULES = (
+    re.compile(r"-?ep(\d+)-?", re.IGNORECASE).search,
+    re.compile(r"-?s\d+e(\d+)-?", re.IGNORECASE).search,
+    re.compile(r"-?(\d+)(v\d|end)?-?$", re.IGNORECASE).match,
+)
+
+
+def _episode_from_tags(tags: list[str]) -> int | None:
+    for tag in tags:
+        for rule in TAG_EPISODE_RULES:
+            if res := rule(tag):
+                return int(res.group(1))
+    return None
+
+
+def _episode_from_title_parts(title_parts: list[str]) -> int | None:
+    """title_parts is modified in place to remove the episode part"""
+    for i, part in enumerate(title_parts):
+        # ANi style
+        if (
+            part == "Season"
+            and i + 3 < len(title_parts)
+            and title_parts[i + 1].isdigit()
+            and title_parts[i + 2] == "-"
+            and title_parts[i + 3].isdigit()
+        ):
+            episode = int(title_parts[i + 3])
+            del title_parts[i + 2 : i + 4]
+            return episode
+
+        for rule in PART_EPISODE_RULES:
+            if res := rule(part):
+                title_parts[i] = part[: res.start()] + " " + part[res.end() :]
+                if not title_parts[i].strip():
+                    title_parts[i] = "-"
+                return int(res.group(1))
+    return None
+
+
+@lru_cache(maxsize=4096)
+def parse_filename(filename: str) -> InfoFromFileName:
+    filename = filename.strip().rsplit(".", 1)[0]  # Remove file extension
+    tags = [tag.strip() for tag in TAGS_RE.findall(filename)]
+    title_parts = [
+        word for text in TAGS_RE.split(filename)[::2] for word in text.split()
+    ]
+
+    episode = _episode_from_tags(tags)
+    if episode is None:
+        episode = _episode_from_title_parts(title_parts)
+
+    if not title_parts:
+        title = None
+    else:
+        title = " ".join(p for p in title_parts if p != "-")
+
+    return InfoFromFileName(title=title, tags=tuple(tags), episode=episode)
+
+
+def parse_many(filenames: Iterable[str]) -> list[InfoFromFileName]:
+    return [parse_filename(filename) for filename in filenames]
+
+
+extract_info_from_filename = parse_filename
@@ -1,12 +1,26 @@
+import asyncio
+import bisect
+import heapq
 import json
 import os
+import re
+import time
 import typing
+import unicodedata
 from pathlib import Path
 
-from openai import AsyncOpenAI
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncOpenAI,
+    InternalServerError,
+    RateLimitError,
+)
 
 from bgm import logger
+from bgm.api import get_retry_after
 from bgm.config import config
+from bgm.db import db
 
 
 SYSTEM_PROMPT = (
@@ -22,13 +36,102 @@ SYSTEM_PROMPT = (
 )
 
 
+CHUNK_SIZE = 100
+# attempts per chunk on 429, connection errors, timeouts and 5xx
+LLM_RETRIES = 5
+
+
+def normalize_text(text: str) -> str:
+    """translation memory key, NFKC folds fullwidth and halfwidth forms (ｗｗ → ww)"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+# common net slang, matched on the normalized text without trailing stretches
+SLANG = {
+    "乙": "辛苦了",
+    "おつ": "辛苦了",
+    "お疲れ": "辛苦了",
+    "うぽつ": "感谢up主",
+    "かわいい": "可爱",
+    "可愛い": "可爱",
+    "カワイイ": "可爱",
+    "かっこいい": "好帅",
+    "キタ": "来了",
+    "きた": "来了",
+    "ナイス": "漂亮",
+    "すごい": "好厉害",
+    "すげ": "好厉害",
+    "おめでとう": "恭喜",
+    "ありがとう": "谢谢",
+    "こわい": "好可怕",
+    "怖い": "好可怕",
+    "神回": "神回",
+    "笑": "笑",
+    "草": "草",
+}
+# kanji-only comments this short are as likely Japanese (本当, 上手) as Chinese
+CHINESE_MIN_LEN = 4
+# common Japanese kanji compounds written with characters Chinese also has
+JAPANESE_KANJI_WORDS = (
+    "本当", "上手", "大丈夫", "最高", "大切", "仕方", "心配", "失礼",
+    "残念", "面白", "可哀想", "迫力",
+)
+W_RUN_RE = re.compile(r"[wW]+")
+STRETCH_RE = re.compile(r"[ー〜~!?.…・。、━-]+$")
+
+
+def _is_simplified_han(ch: str) -> bool:
+    """Japanese-only kanji such as 気 or 楽 are missing from GB2312"""
+    try:
+        ch.encode("gb2312")
+    except UnicodeEncodeError:
+        return False
+    return unicodedata.name(ch, "").startswith("CJK UNIFIED IDEOGRAPH")
+
+
+def local_translation(text: str) -> str | None:
+    """translation of comments that need no LLM, None for the others
+
+    Numbers, punctuation and emoji and comments already in Chinese are kept
+    as they are, w runs become 哈, and a few slang words come from SLANG.
+    """
+    norm = normalize_text(text)
+    if all(unicodedata.category(ch)[0] in "NPSZ" for ch in norm):
+        return text
+    if W_RUN_RE.fullmatch(norm):
+        return "哈" * min(len(norm), 6)
+    if (slang := SLANG.get(STRETCH_RE.sub("", norm))) is not None:
+        return slang
+    letters = [ch for ch in norm if unicodedata.category(ch)[0] == "L"]
+    if (
+        len(letters) >= CHINESE_MIN_LEN
+        and all(map(_is_simplified_han, letters))
+        and not any(word in norm for word in JAPANESE_KANJI_WORDS)
+    ):
+        return text
+    return None
+
+
 class LLMClient:
     def __init__(self):
         self.api_key = os.environ.get("LLM_API_KEY")
         llm_cfg = config.llm
         self.base_url = llm_cfg.base_url if llm_cfg else "https://api.openai.com/v1"
         self.model = llm_cfg.model if llm_cfg else "gpt-4o-mini"
-        self.client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url)
+        self.max_concurrency = max(llm_cfg.max_concurrency if llm_cfg else 4, 1)
+        # retried by DanmakuTranslator, a 429 pauses every worker
+        self.client = AsyncOpenAI(
+            api_key=self.api_key, base_url=self.base_url, max_retries=0
+        )
+        # requests wait until then after a 429 (time.monotonic)
+        self.paused_until = 0.0
+
+    async def wait_if_paused(self):
+        while (delay := self.paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, delay: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
 
     async def chat_lines(self, system: str, user: str) -> dict[str, str]:
         resp = await self.client.chat.completions.create(
@@ -77,117 +180,248 @@ class LLMClient:
         return result
 
 
+_llm_client: LLMClient | None = None
+
+
+def get_llm_client() -> LLMClient:
+    """shared by every translator, so concurrent episodes share one connection pool"""
+    global _llm_client
+    if _llm_client is None:
+        _llm_client = LLMClient()
+    return _llm_client
+
+
 class DanmakuTranslator:
     def __init__(self, data_path: Path, video_id: str):
         self.data_path = data_path
         self.video_id = video_id
-        self.cache_path = data_path / f"{video_id}.translation.json"
-        self._llm: LLMClient | None = None
+        # append-only journal of [comment key, translation] lines, see _load_cache
+        self.cache_path = data_path / f"{video_id}.translation.jsonl"
+        # whole-file cache of older versions, converted on load
+        self.legacy_cache_path = data_path / f"{video_id}.translation.json"
 
     @property
     def llm(self) -> LLMClient:
-        if self._llm is None:
-            self._llm = LLMClient()
-        return self._llm
+        return get_llm_client()
 
     async def translate(
         self,
         danmaku: list[dict],
         title: str,
         on_update: typing.Callable[[list[dict], bool], typing.Awaitable[None]],
+        playhead: typing.Callable[[], typing.Awaitable[float | None]] | None = None,
     ) -> None:
+        """`playhead` returns the playback position, comments shown next go first"""
         if not danmaku:
             await on_update(danmaku, True)
             return
 
         sorted_danmaku = sorted(danmaku, key=lambda d: float(d["p"].split(",")[0]))
-        cache = self._load_cache()
+        translations = self._load_cache()
 
-        translations: dict[str, str] = cache.get("translations", {}).copy()
-        translated_keys = set(translations.keys())
+        # comments left to translate, grouped by normalized text, in time order
+        groups: dict[str, list[dict]] = {}
+        for d in sorted_danmaku:
+            if self._comment_key(d) not in translations:
+                groups.setdefault(normalize_text(d["m"]), []).append(d)
 
-        untranslated = [
-            (i, d) for i, d in enumerate(sorted_danmaku)
-            if self._comment_key(d) not in translated_keys
-        ]
+        local: dict[str, str] = {}
+        for source in list(groups):
+            if local_translation(source) is None:
+                continue
+            for d in groups.pop(source):
+                local[self._comment_key(d)] = local_translation(d["m"]) or d["m"]
+        translations.update(local)
 
-        if not untranslated:
-            self._apply_translations(sorted_danmaku, translations)
+        model = self.llm.model
+        memory = db.get_translations(model, list(groups))
+        remembered: dict[str, str] = {}
+        for source, trans in memory.items():
+            for d in groups.pop(source):
+                remembered[self._comment_key(d)] = trans
+        translations.update(remembered)
+        self._append_cache(remembered)
+
+        self._apply_translations(sorted_danmaku, translations)
+        if not groups:
             await on_update(sorted_danmaku, True)
             return
 
-        logger.info("llm: translating %d untranslated comments", len(untranslated))
-
-        self._apply_translations(sorted_danmaku, translations)
+        logger.info(
+            "llm: translating %d unique texts of %d comments, "
+            "%d texts from memory, %d comments resolved locally",
+            len(groups), sum(map(len, groups.values())), len(memory), len(local),
+        )
         await on_update(sorted_danmaku, False)
 
-        CHUNK_SIZE = 100
-        n_chunks = (len(untranslated) + CHUNK_SIZE - 1) // CHUNK_SIZE
+        sources = list(groups)
+        # occurrence times of each unique text, ascending
+        times = [[float(d["p"].split(",")[0]) for d in groups[source]] for source in sources]
+        pending = set(range(len(sources)))
+        n_chunks = (len(sources) + CHUNK_SIZE - 1) // CHUNK_SIZE
+        n_picked = 0
 
-        for ci in range(n_chunks):
-            is_last = ci == n_chunks - 1
-            start = ci * CHUNK_SIZE
-            end = min(start + CHUNK_SIZE, len(untranslated))
-            chunk = untranslated[start:end]
-            input_lines = "\n".join(
-                f"{i}|{d['p'].split(',')[0]}|{d['m']}"
-                for i, d in chunk
-            )
+        def upcoming(i: int, pos: float) -> tuple[int, float, int]:
+            """sort key of a text and the index of its next occurrence after `pos`"""
+            j = bisect.bisect_left(times[i], pos)
+            if j < len(times[i]):
+                return 0, times[i][j] - pos, j
+            # only shown before the playhead: after everything ahead of it, in time order
+            return 1, times[i][0], 0
 
-            logger.info("llm: chunk %d/%d (%d–%d)",
-                        ci + 1, n_chunks, start, end - 1)
+        def next_chunk(pos: float) -> list[tuple[int, dict]]:
+            """the pending texts shown soonest after `pos`, each with its next occurrence"""
+            keys = {i: upcoming(i, pos) for i in pending}
+            chosen = heapq.nsmallest(CHUNK_SIZE, pending, key=keys.__getitem__)
+            pending.difference_update(chosen)
+            return [(i, groups[sources[i]][keys[i][2]]) for i in chosen]
 
-            try:
-                result = await self.llm.chat_lines(SYSTEM_PROMPT, input_lines)
-            except Exception as e:
-                logger.error("llm: chunk %d/%d failed: %s", ci + 1, n_chunks, e)
-                continue
+        async def worker():
+            nonlocal n_picked
+            while pending:
+                # asked before every chunk, so a seek takes effect at the next one
+                pos = await playhead() if playhead else None
+                if not pending:
+                    break
+                chunk = next_chunk(pos or 0.0)
+                ci, n_picked = n_picked, n_picked + 1
+                result = await self._translate_chunk(ci, n_chunks, chunk)
+                if result is None:
+                    continue
 
-            expected_ids = {str(i) for i, _ in chunk}
-            missing = expected_ids - result.keys()
-            if missing:
-                logger.warning("llm: chunk %d/%d missing %d/%d IDs: %s",
-                               ci + 1, n_chunks, len(missing), len(chunk),
-                               sorted(missing, key=int)[:10])
-
-            for i, d in chunk:
-                key = self._comment_key(d)
-                trans = result.get(str(i))
-                if trans is not None:
-                    translations[key] = trans
+                learned: dict[str, str] = {}
+                new: dict[str, str] = {}
+                for i, _ in chunk:
+                    trans = result.get(str(i))
+                    if trans is None:
+                        continue
+                    learned[sources[i]] = trans
+                    for d in groups[sources[i]]:
+                        new[self._comment_key(d)] = trans
+                db.set_translations(model, learned)
+                translations.update(new)
+                self._append_cache(new)
 
-            self._apply_translations(sorted_danmaku, translations)
-            self._write_cache(translations)
-            logger.debug("llm: progress %d/%d", len(translations), len(sorted_danmaku))
+                self._apply_translations(sorted_danmaku, translations)
+                logger.debug("llm: progress %d/%d", len(translations), len(sorted_danmaku))
+                if pending:
+                    await on_update(sorted_danmaku, False)
 
-            if not is_last:
-                await on_update(sorted_danmaku, False)
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(min(self.llm.max_concurrency, n_chunks)):
+                tg.create_task(worker())
 
         await on_update(sorted_danmaku, True)
 
+    async def _translate_chunk(
+        self, ci: int, n_chunks: int, chunk: list[tuple[int, dict]]
+    ) -> dict[str, str] | None:
+        input_lines = "\n".join(
+            f"{i}|{d['p'].split(',')[0]}|{d['m']}"
+            for i, d in chunk
+        )
+        logger.info("llm: chunk %d/%d (%d items)", ci + 1, n_chunks, len(chunk))
+
+        error: Exception | None = None
+        for attempt in range(LLM_RETRIES):
+            await self.llm.wait_if_paused()
+            try:
+                result = await self.llm.chat_lines(SYSTEM_PROMPT, input_lines)
+                break
+            except RateLimitError as e:
+                error = e
+                delay = get_retry_after(e.response.headers) or 2 ** (attempt + 1)
+                logger.warning("llm: rate limited, pausing %.1fs", delay)
+                self.llm.pause(delay)
+            except (APIConnectionError, APITimeoutError, InternalServerError) as e:
+                error = e
+                delay = 2 ** (attempt + 1)
+                logger.warning("llm: chunk %d/%d: %s, retrying in %ds",
+                               ci + 1, n_chunks, e, delay)
+                await asyncio.sleep(delay)
+            except Exception as e:
+                logger.error("llm: chunk %d/%d failed: %s", ci + 1, n_chunks, e)
+                return None
+        else:
+            logger.error("llm: chunk %d/%d failed: %s", ci + 1, n_chunks, error)
+            return None
+
+        expected_ids = {str(i) for i, _ in chunk}
+        missing = expected_ids - result.keys()
+        if missing:
+            logger.warning("llm: chunk %d/%d missing %d/%d IDs: %s",
+                           ci + 1, n_chunks, len(missing), len(chunk),
+                           sorted(missing, key=int)[:10])
+        return result
+
     @staticmethod
     def _comment_key(d: dict) -> str:
-        return f"{d['p'].split(',')[0]}|{d['m']}"
+        return f"{d['p'].split(',')[0]}|{d.get('m_original', d['m'])}"
 
-    def _load_cache(self) -> dict:
-        if not self.cache_path.exists():
-            return {}
+    def _load_cache(self) -> dict[str, str]:
+        """read the journal line by line, later lines win and broken ones are skipped
+
+        The journal is compacted here when it holds many overwritten or broken
+        lines, or ends with a line torn by a crash.
+        """
+        translations: dict[str, str] = {}
+        needs_compaction = self.legacy_cache_path.exists()
+        if needs_compaction:
+            try:
+                with self.legacy_cache_path.open("r", encoding="utf-8") as f:
+                    translations.update(json.load(f).get("translations", {}))
+            except (json.JSONDecodeError, OSError, AttributeError):
+                logger.warning("llm: failed to load translation cache %s", self.legacy_cache_path)
+
+        n_lines = n_broken = 0
         try:
-            with self.cache_path.open("r", encoding="utf-8") as f:
-                return json.load(f)
-        except (json.JSONDecodeError, OSError):
+            with self.cache_path.open("r", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    n_lines += 1
+                    try:
+                        key, trans = json.loads(line)
+                    except (ValueError, TypeError):
+                        n_broken += 1
+                        continue
+                    if not line.endswith("\n"):
+                        n_broken += 1  # the next append would be glued to it
+                    translations[key] = trans
+        except FileNotFoundError:
+            pass
+        except OSError:
             logger.warning("llm: failed to load translation cache %s", self.cache_path)
-            return {}
+            return translations
 
-    def _write_cache(self, translations: dict[str, str]) -> None:
+        if n_broken:
+            logger.warning("llm: skipped %d broken lines of %s", n_broken, self.cache_path)
+        if needs_compaction or n_broken or n_lines > 2 * len(translations) + CHUNK_SIZE:
+            self._compact_cache(translations)
+        return translations
+
+    def _append_cache(self, translations: typing.Mapping[str, str]) -> None:
+        if not translations:
+            return
+        self.data_path.mkdir(parents=True, exist_ok=True)
+        with self.cache_path.open("a", encoding="utf-8") as f:
+            f.write("".join(self._journal_line(k, v) for k, v in translations.items()))
+
+    def _compact_cache(self, translations: typing.Mapping[str, str]) -> None:
+        """rewrite the journal with one line per key, atomically"""
         self.data_path.mkdir(parents=True, exist_ok=True)
-        with self.cache_path.open("w", encoding="utf-8") as f:
-            json.dump({"translations": translations}, f, ensure_ascii=False)
+        tmp_path = self.cache_path.with_suffix(".tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            f.write("".join(self._journal_line(k, v) for k, v in translations.items()))
+        os.replace(tmp_path, self.cache_path)
+        self.legacy_cache_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def _journal_line(key: str, trans: str) -> str:
+        return json.dumps([key, trans], ensure_ascii=False) + "\n"
 
     @staticmethod
     def _apply_translations(danmaku: list[dict], translations: dict[str, str]) -> None:
         for d in danmaku:
-            key = f"{d['p'].split(',')[0]}|{d['m']}"
+            key = DanmakuTranslator._comment_key(d)
             if trans := translations.get(key):
-                d["m_original"] = d["m"]
+                d.setdefault("m_original", d["m"])
                 d["m"] = trans
@@ -1,12 +1,14 @@
 import logging
 import sys
+from typing import TYPE_CHECKING
 from python_mpv_jsonipc import MPV
-from bgm.mpvbangumi import MPVBangumi
-from bgm import LOG_LEVEL
+from bgm import CONFIG_PATH, LOG_LEVEL, PROPERTY_DISPATCH
 import json
 import threading
 import traceback
-import portalocker
+
+if TYPE_CHECKING:
+    from bgm.mpvbangumi import MPVBangumi
 
 
 def exception_hook(args):
@@ -15,41 +17,76 @@ def exception_hook(args):
             args.exc_type, args.exc_value, args.exc_traceback, file=sys.stdout
         )
     exit(0)
-threading.excepthook = exception_hook
 
-if LOG_LEVEL > logging.DEBUG:
-    import os
 
-    sys.stderr = open(os.devnull, "w")
+# everything happens in main(): the layout worker process (see bgm.danmaku)
+# imports the entry script again and must not connect to mpv
+def main():
+    threading.excepthook = exception_hook
 
-ipc_socket = sys.argv[1]
-if sys.platform == "win32":
-    portalocker.portalocker.LOCKER = portalocker.portalocker.Win32Locker
-    assert ipc_socket.startswith("\\\\.\\pipe\\")
-    ipc_socket = ipc_socket.replace("\\\\.\\pipe\\", "", count=1)
+    if LOG_LEVEL > logging.DEBUG:
+        import os
 
-mpv = MPV(start_mpv=False, ipc_socket=ipc_socket, quit_callback=lambda *_: exit(0))
-bgm = MPVBangumi(mpv)
+        sys.stderr = open(os.devnull, "w")
 
+    args = sys.argv[1:]
+    # `bgm --daemon <ipc>`: share one process between mpv instances, see bgm.daemon
+    daemon_mode = "--daemon" in args
+    if daemon_mode:
+        args.remove("--daemon")
 
-@mpv.property_observer("user-data/mpv_bangumi/dispatch")
-def dispatch(name: str, value: str):
-    if not value:
-        return
-    info = json.loads(value)
-    action = info["action"]
-    data = info["data"]
-    del value, info
+    if not args or not (CONFIG_PATH / "config.toml").exists():
+        # creates the config interactively and exits
+        import bgm.config  # noqa: F401
 
-    bgm.send_action(action, data)
+    ipc_socket = args[0]
+    if sys.platform == "win32":
+        import portalocker
 
+        portalocker.portalocker.LOCKER = portalocker.portalocker.Win32Locker
+        assert ipc_socket.startswith("\\\\.\\pipe\\")
+        ipc_socket = ipc_socket.replace("\\\\.\\pipe\\", "", count=1)
 
-def main():
-    bgm.resp_message("ready", {"ok": True})
+    if daemon_mode:
+        from bgm import daemon
+
+        if daemon.attach(ipc_socket):
+            exit(0)
+        if daemon.is_daemon():
+            daemon.Daemon().serve(ipc_socket)
+            exit(0)
+
+    # set when the connection to mpv dies, i.e. mpv quit
+    quit_event = threading.Event()
+    mpv = MPV(
+        start_mpv=False, ipc_socket=ipc_socket, quit_callback=lambda *_: quit_event.set()
+    )
+    player: "MPVBangumi | None" = None
+    # set once the player is created, actions sent right after `ready` wait for it
+    bgm_ready = threading.Event()
+
+    @mpv.property_observer(PROPERTY_DISPATCH)
+    def dispatch(name: str, value: str):
+        bgm_ready.wait()
+        assert player is not None
+        player.dispatch(name, value)
+
+    # `ready` goes out before the heavy imports (aiohttp, pydantic, config, db),
+    # so the lua side can go on with its own initialization meanwhile
+    mpv.command(
+        "script-message",
+        "mpvbangumi-action",
+        json.dumps({"action": "ready", "data": {"ok": True}}),
+    )
+    from bgm.mpvbangumi import MPVBangumi
+
+    player = MPVBangumi(mpv)
+    bgm_ready.set()
+    quit_event.wait()
     try:
-        while True:
-            mpv.wait_for_property("duration")
+        # flushes the bangumi outbox and closes the http pool
+        player.close()
     except Exception:
         if LOG_LEVEL <= logging.DEBUG:
             traceback.print_exc()
-        exit(0)
+    exit(0)
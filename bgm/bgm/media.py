@@ -0,0 +1,85 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import hashlib
+import mimetypes
+from pathlib import Path
+
+from bgm import logger
+from bgm.db import ProbeResult, db
+
+
+@dataclass
+class VideoInfo:
+    hash: str
+    duration: int
+    filename: str
+    size: int
+    resolution: tuple[int, int]
+
+
+def check_video(file_path: Path) -> bool:
+    if not file_path.exists():
+        return False
+    try:
+        guess = mimetypes.guess_type(file_path)[0]
+        return guess.startswith("video") if guess is not None else False
+    except FileNotFoundError:
+        return False
+
+
+def get_hash(video_path: Path) -> str:
+    assert video_path.exists()
+    with open(video_path, "rb") as f:
+        # 16 * 1024 * 1024 = 16777216
+        return hashlib.md5(f.read(16777216)).hexdigest().upper()
+
+
+def get_duration_and_resolution(video_path: Path) -> tuple[int, tuple[int, int]]:
+    """path must exist, the container is parsed only once"""
+    from pymediainfo import MediaInfo
+
+    track = MediaInfo.parse(video_path).video_tracks[0]
+    return (
+        int(float(track.duration) / 1000),  # type: ignore
+        (track.width, track.height),  # type: ignore
+    )
+
+
+# hashing and MediaInfo parsing are blocking, keep them off the event loop
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="bgm-probe")
+_probing: dict[Path, asyncio.Future[ProbeResult]] = {}
+
+
+async def _probe(video_path: Path) -> ProbeResult:
+    loop = asyncio.get_running_loop()
+    file_hash, (duration, resolution) = await asyncio.gather(
+        loop.run_in_executor(_executor, get_hash, video_path),
+        loop.run_in_executor(_executor, get_duration_and_resolution, video_path),
+    )
+    return ProbeResult(file_hash, duration, *resolution)
+
+
+async def probe_video(video_path: Path) -> VideoInfo:
+    """path must exist, results are cached in db until the file changes"""
+    stat = video_path.stat()
+    result = db.get_probe_result(str(video_path), stat.st_size, stat.st_mtime_ns)
+    if result is None:
+        # concurrent probes of the same file share one parse
+        if video_path not in _probing:
+            _probing[video_path] = asyncio.ensure_future(_probe(video_path))
+            _probing[video_path].add_done_callback(
+                lambda _: _probing.pop(video_path, None)
+            )
+        result = await asyncio.shield(_probing[video_path])
+        db.set_probe_result(str(video_path), stat.st_size, stat.st_mtime_ns, result)
+    else:
+        logger.debug("probe cache hit: %s", video_path.name)
+
+    return VideoInfo(
+        hash=result.hash,
+        duration=result.duration,
+        filename=video_path.stem,
+        size=stat.st_size,
+        resolution=(result.width, result.height),
+    )
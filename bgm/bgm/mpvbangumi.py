@@ -1,16 +1,30 @@
+import asyncio
+from collections import Counter
+from concurrent.futures.process import BrokenProcessPool
+from contextvars import ContextVar
+import itertools
 import json
+import os
+import time
 from typing import Any, Awaitable
 import logging
-from bgm import logger, NOTIFY_LEVEL_NUM
-from bgm.danmaku import convert_dandanplay_json2danmaku_events, get_style_config
+import threading
+from bgm import DATA_PATH, logger, NOTIFY_LEVEL_NUM
+from bgm.danmaku import (
+    get_layout_pool,
+    layout_payload,
+    shutdown_layout_pool,
+    warmup_layout_pool,
+)
 from bgm.db import EpisodeMatch
-from bgm.niconico import niconico_fetch_danmaku
 from bgm.source import get_sources, set_source_status
 from bgm.utils import AsyncWorker
+from bgm.api import http_pool, rate_limiter
 from bgm.dandanplay import dandanplay_get_episodes, dandanplay_login_or_update, dandanplay_search, match_video, dandanplay_comment
 from bgm.dandanplay import fetch_danmaku as dandanplay_fetch_danmaku
 from bgm.bangumi import (
     bangumi_fetch_episodes,
+    bangumi_flush_outbox,
     bangumi_update_collection,
     bangumi_update_episode,
 )
@@ -20,8 +34,51 @@ from threading import Lock
 from python_mpv_jsonipc import MPV
 
 
+# larger payloads are passed to lua through a file instead of the IPC socket
+IPC_INLINE_LIMIT = 64 * 1024
+PAYLOAD_PATH = DATA_PATH / "ipc"
+PAYLOAD_MAX_AGE = 24 * 3600
+_payload_ids = itertools.count()
+
+
+def write_payload(payload: str) -> Path:
+    """lua deletes the file once read"""
+    path = PAYLOAD_PATH / f"{os.getpid()}-{next(_payload_ids)}.json"
+    path.write_text(payload, encoding="utf-8")
+    return path
+
+
+def cleanup_payloads():
+    """remove payloads left by players that quit before reading them"""
+    PAYLOAD_PATH.mkdir(parents=True, exist_ok=True)
+    now = time.time()
+    for path in PAYLOAD_PATH.iterdir():
+        try:
+            if now - path.stat().st_mtime > PAYLOAD_MAX_AGE:
+                path.unlink()
+        except OSError:
+            pass
+
+
+# the player a task or IPC callback works for, logs are only sent to that player
+current_player: ContextVar["MPVBangumi | None"] = ContextVar(
+    "current_player", default=None
+)
+# the playback generation a task was started in, None outside of tasks
+current_generation: ContextVar[int | None] = ContextVar(
+    "current_generation", default=None
+)
+
+
 class MPVLogHandler(logging.Handler):
-    def __init__(self, sender, *args, **kwargs):
+    """forward logs to mpv, batched into one `logs` message per interval"""
+
+    FLUSH_INTERVAL = 0.2
+    # verbose records per second, the rest are only counted
+    VERBOSE_RATE = 50
+    IMMEDIATE_LEVELS = ("notify", "error")
+
+    def __init__(self, sender, *args, owner: "MPVBangumi | None" = None, **kwargs):
         super().__init__(*args, **kwargs)
         self.level_mapping = {
             logging.DEBUG: "verbose",
@@ -31,75 +88,270 @@ class MPVLogHandler(logging.Handler):
             NOTIFY_LEVEL_NUM: "notify",
         }
         self.sender = sender
+        self.owner = owner
+
+        self.pending: list[dict] = []
+        self.pending_lock = threading.Lock()
+        # held from taking a batch until it is sent, so records reach mpv in order
+        self.send_lock = threading.RLock()
+        self.dropped = 0
+        self.window_start = 0.0
+        self.window_count = 0
+        self.stopped = threading.Event()
+        self.flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flush_thread.start()
 
     def emit(self, record):
         try:
             if record.levelno not in self.level_mapping:
                 return
+            player = current_player.get()
+            if player is not None and player is not self.owner:
+                return
             level = self.level_mapping[record.levelno]
-            msg = self.format(record)
-            self.sender("log", {"level": level, "msg": msg})
+            entry = {"level": level, "msg": self.format(record)}
+            if level in self.IMMEDIATE_LEVELS:
+                with self.send_lock:
+                    self.flush()
+                    self.sender("log", entry)
+                return
+            with self.pending_lock:
+                if level == "verbose" and not self._allow_verbose():
+                    self.dropped += 1
+                    return
+                self.pending.append(entry)
         except Exception:
             self.handleError(record)
 
+    def _allow_verbose(self) -> bool:
+        now = time.monotonic()
+        if now - self.window_start >= 1:
+            self.window_start = now
+            self.window_count = 0
+        self.window_count += 1
+        return self.window_count <= self.VERBOSE_RATE
+
+    def flush(self):
+        with self.send_lock:
+            with self.pending_lock:
+                records, self.pending = self.pending, []
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                records.append(
+                    {"level": "verbose", "msg": f"{dropped} verbose log records dropped"}
+                )
+            if records:
+                self.sender("logs", {"records": records})
+
+    def _flush_loop(self):
+        while not self.stopped.wait(self.FLUSH_INTERVAL):
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def close(self):
+        self.stopped.set()
+        try:
+            self.flush()
+        except Exception:
+            pass
+        super().close()
+
+
+def shutdown_worker(worker: AsyncWorker):
+    """flush pending work and release the shared resources of `worker`"""
+    try:
+        worker.run(bangumi_flush_outbox())
+    except Exception as e:
+        logger.debug("outbox not flushed on exit: %r", e)
+    worker.run(http_pool.close())
+    worker.stop()
+    shutdown_layout_pool()
+
 
 class MPVBangumi:
-    def __init__(self, mpv: MPV) -> None:
+    def __init__(self, mpv: MPV, worker: AsyncWorker | None = None) -> None:
+        """a shared `worker` (daemon mode) is left running on close"""
         self.mpv = mpv
-        self.worker = AsyncWorker()
+        self.owns_worker = worker is None
+        self.worker = worker or AsyncWorker()
         self.rid = 0
         self.ipc_command_lock = Lock()
-        self.mpv_log_handler = MPVLogHandler(sender=self.resp_message)
+        # bumped on every file-loaded or new match, tasks of older generations are cancelled
+        self.generation = 0
+        self.tasks: dict[Any, int] = {}
+        self.tasks_lock = Lock()
+        self.metrics: Counter[str] = Counter()
+
+        self.mpv_log_handler = MPVLogHandler(sender=self.resp_message, owner=self)
         logger.addHandler(self.mpv_log_handler)
+        cleanup_payloads()
+        warmup_layout_pool()
+        if self.owns_worker:
+            self.add_task(http_pool.warmup(), bound=False)
+            self.add_task(bangumi_flush_outbox(), bound=False)
 
         self.__comments: dict[str, list[Any]] = {}
         # self.command_lock = Lock()
+        # only the latest layout is sent, earlier ones may finish later
+        self.layout_seq = 0
 
     def close(self):
-        self.worker.stop()
+        # mpv is gone or going, nothing more can be shown there
         logger.removeHandler(self.mpv_log_handler)
+        self.mpv_log_handler.close()
+        self.log_metrics()
+        if self.owns_worker:
+            shutdown_worker(self.worker)
 
     def clear_comments(self):
         self.__comments = {}
 
     def update_comments(self, source: str, comments: list[dict], silent: bool = False):
         """comments in dandanplay style"""
+        if self.is_stale():
+            self.metrics["dropped_results"] += 1
+            return
         self.__comments[source] = comments
         if not silent:
             logger.info(f"source {source}: {len(comments)} danmakus")
 
-        events = convert_dandanplay_json2danmaku_events(
-            list(chain(*self.__comments.values()))
-        )
-        self.resp_message(
-            "set-danmaku",
-            {
-                "sources": list(self.__comments.keys()),
-                "events": [e.model_dump() for e in events],
-                "style": get_style_config(),
-            },
+        self.layout_seq += 1
+        self.add_task(
+            self._send_danmaku(
+                self.layout_seq,
+                list(self.__comments.keys()),
+                # snapshot, the layout process pickles them in another thread
+                [dict(c) for c in chain(*self.__comments.values())],
+            )
         )
 
-    def add_task(self, task: Awaitable):
-        self.worker.submit_task(task)
+    async def _send_danmaku(self, seq: int, sources: list[str], comments: list[dict]):
+        """layout and encoding are CPU bound, they run in the layout process"""
+        loop = asyncio.get_running_loop()
+        try:
+            payload = await loop.run_in_executor(
+                get_layout_pool(), layout_payload, sources, comments
+            )
+        except BrokenProcessPool:
+            logger.warning("layout process died, laying out in a thread")
+            shutdown_layout_pool()
+            payload = await asyncio.to_thread(layout_payload, sources, comments)
+        if seq != self.layout_seq:
+            self.metrics["superseded_layouts"] += 1
+            return
+        if self.is_stale():
+            self.metrics["dropped_results"] += 1
+            return
+        self.send_payload("set-danmaku", payload)
+
+    def add_task(self, task: Awaitable, bound: bool = True):
+        """a `bound` task belongs to the current file and is cancelled when it changes"""
+        generation = current_generation.get()
+        if generation is None:
+            generation = self.generation
+        if bound and generation != self.generation:
+            # spawned by a task of a previous file
+            if hasattr(task, "close"):
+                task.close()  # type: ignore[attr-defined]
+            self.metrics["skipped_tasks"] += 1
+            return
+
+        fut = self.worker.submit_task(self._run_for_player(task, generation))
+        if not bound:
+            return
+        with self.tasks_lock:
+            self.tasks[fut] = generation
+        fut.add_done_callback(self._forget_task)
+
+    def _forget_task(self, fut):
+        with self.tasks_lock:
+            self.tasks.pop(fut, None)
+
+    async def _run_for_player(self, task: Awaitable, generation: int):
+        current_player.set(self)
+        current_generation.set(generation)
+        return await task
+
+    def is_stale(self) -> bool:
+        """whether the running task was started for a previous file"""
+        generation = current_generation.get()
+        return generation is not None and generation != self.generation
+
+    def log_metrics(self):
+        """cumulative, logged for every new file while mpv can still show them"""
+        logger.debug("task metrics: %s", dict(self.metrics))
+        logger.debug("http metrics: %s", rate_limiter.metrics())
+
+    def new_generation(self):
+        self.log_metrics()
+        with self.tasks_lock:
+            self.generation += 1
+            stale = list(self.tasks)
+        for fut in stale:
+            self.worker.cancel(fut)
+        self.metrics["cancelled_tasks"] += len(stale)
+        self.clear_comments()
+        if stale:
+            logger.debug(
+                "generation %d: cancelled %d stale tasks", self.generation, len(stale)
+            )
+
+    async def get_time_pos(self) -> float | None:
+        """playback position, None when nothing is playing"""
+        try:
+            return await asyncio.to_thread(self.mpv.command, "get_property", "time-pos")
+        except Exception:
+            return None
 
     def resp_message(self, action: str, data: Any):
-        self.mpv.command(
-            "script-message",
-            "mpvbangumi-action",
-            json.dumps(
-                {"action": action, "data": data},
+        # log records are never stale, a batch also holds records of other tasks
+        if action not in ("log", "logs") and self.is_stale():
+            self.metrics["dropped_results"] += 1
+            return
+        self.send_payload(action, json.dumps(data, ensure_ascii=True))
+
+    def send_payload(self, action: str, payload: str):
+        """`payload` is the json encoded data"""
+        if len(payload) > IPC_INLINE_LIMIT:
+            message = json.dumps(
+                {"action": action, "file": str(write_payload(payload))},
                 ensure_ascii=True,
-            ),
-        )
+            )
+        else:
+            message = f'{{"action": {json.dumps(action)}, "data": {payload}}}'
+        self.mpv.command("script-message", "mpvbangumi-action", message)
+
+    def dispatch(self, name: str, value: str):
+        """observer of PROPERTY_DISPATCH"""
+        if not value:
+            return
+        info = json.loads(value)
+        action = info["action"]
+        data = info["data"]
+        del value, info
+
+        self.send_action(action, data)
 
     def send_action(self, action: str, data: Any):
+        current_player.set(self)
         if isinstance(data, str):
             data = json.loads(data)
 
-        if action == "match":
+        if action == "reset":
+            self.new_generation()
+        elif action == "match":
+            # not a separate "reset": mpv merges quick writes of the dispatch
+            # property, so it could be lost behind the match
+            self.new_generation()
             self.add_task(
-                match_video(self, Path(data["path"]), force_id=data.get("force_id"))
+                match_video(
+                    self,
+                    Path(data["path"]),
+                    force_id=data.get("force_id"),
+                    playlist=data.get("playlist") or [],
+                )
             )
         elif action == "sources":
             self.clear_comments()
@@ -110,8 +362,10 @@ class MPVBangumi:
                 self.add_task(
                     dandanplay_fetch_danmaku(self, data["episode_info"].episodeId)
                 )
-                self.add_task(dandanplay_login_or_update())
+                self.add_task(dandanplay_login_or_update(), bound=False)
             elif source == "niconico":
+                from bgm.niconico import niconico_fetch_danmaku
+
                 self.add_task(
                         niconico_fetch_danmaku(
                             self, data["episode_id"], data["options"], data["context"]
@@ -119,14 +373,15 @@ class MPVBangumi:
                 )
 
         elif action == "update-bangumi-metadata":
-            self.add_task(bangumi_update_collection(self, data["bgm_id"]))
+            self.add_task(bangumi_update_collection(self, data["bgm_id"]), bound=False)
             self.add_task(
                 bangumi_fetch_episodes(self, data["bgm_id"], data["episode_id"])
             )
             self.resp_message("set-bangumi-id", {"bgm_id": data["bgm_id"]})
         elif action == "update-bangumi-episode":
             self.add_task(
-                bangumi_update_episode(self, data["bgm_id"], data["episode_id"])
+                bangumi_update_episode(self, data["bgm_id"], data["episode_id"]),
+                bound=False,
             )
         elif action == "open-bangumi-url":
             import webbrowser
@@ -141,7 +396,8 @@ class MPVBangumi:
                     color=int(data["color"]),
                     position=int(data["position"]),
                     time=float(data["time"]),
-                )
+                ),
+                bound=False,
             )
         elif action == "search":
             self.add_task(dandanplay_search(self, data["keyword"]))
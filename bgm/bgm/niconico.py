@@ -10,10 +10,12 @@ from html.parser import HTMLParser
 import html
 from typing import TYPE_CHECKING, Any
 
+import aiohttp
 import portalocker
 
 from bgm import logger
 from bgm.config import config
+from bgm.api import http_pool, rate_limiter
 from bgm.source import DanmakuSource
 
 if TYPE_CHECKING:
@@ -46,6 +48,7 @@ NiconicoColorMap = {
 }
 
 BASE_URL = 'https://www.nicovideo.jp'
+REQUEST_TIMEOUT = 30
 HEADERS = {
     'X-Frontend-ID': '6',
     'X-Frontend-Version': '0',
@@ -230,13 +233,19 @@ def _extract_episode_key(title: str, index: int) -> str:
     return str(index)
 
 
-def get_series_data(series: str) -> dict[str, str]:
-    import urllib.request
+async def http_text(url: str, *, headers=None, timeout: float = REQUEST_TIMEOUT) -> str:
+    req_headers = {'User-Agent': 'Mozilla/5.0', **(headers or {})}
+    async with rate_limiter(url).limit(), http_pool.request(
+        'GET', url, headers=req_headers, timeout=aiohttp.ClientTimeout(total=timeout)
+    ) as response:
+        response.raise_for_status()
+        return await response.text(encoding='utf-8', errors='replace')
+
+
+async def get_series_data(series: str) -> dict[str, str]:
     series_id = parse_series_id(series)
     url = f'{BASE_URL}/series/{series_id}'
-    request = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-    with urllib.request.urlopen(request, timeout=30) as response:
-        webpage = response.read().decode('utf-8', errors='replace')
+    webpage = await http_text(url)
 
     parser = _NiconicoSeriesParser()
     parser.feed(webpage)
@@ -302,20 +311,17 @@ def _parse_tktk_video_items(source: str, detail_id: str) -> list[dict[str, str]]
     return items
 
 
-def get_detail_data(detail: str) -> dict[str, str]:
-    import urllib.request
+async def get_detail_data(detail: str) -> dict[str, str]:
     import urllib.parse
 
     detail_id = parse_detail_id(detail)
     url = f'https://anime.nicovideo.jp/detail/{detail_id}/index.html'
-    request = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
     try:
-        with urllib.request.urlopen(request, timeout=30) as response:
-            webpage = response.read().decode('utf-8', errors='replace')
+        webpage = await http_text(url)
     except Exception:
         return {}
 
-    sources = [webpage]
+    script_urls = []
     script_src_re = re.compile(r'<script[^>]+src=["\'](?P<src>[^"\']+)["\']', flags=re.IGNORECASE)
     for match in script_src_re.finditer(webpage):
         src = match.group('src')
@@ -323,15 +329,13 @@ def get_detail_data(detail: str) -> dict[str, str]:
             continue
         if not src.endswith(('/state.js', '/payload.js')):
             continue
+        script_urls.append(urllib.parse.urljoin(url, src))
 
-        script_url = urllib.parse.urljoin(url, src)
-        try:
-            script_req = urllib.request.Request(script_url, headers={'User-Agent': 'Mozilla/5.0'})
-            with urllib.request.urlopen(script_req, timeout=30) as script_response:
-                script_body = script_response.read().decode('utf-8', errors='replace')
-            sources.append(script_body)
-        except Exception:
-            continue
+    # state.js/payload.js are independent, fetch them together
+    scripts = await asyncio.gather(
+        *(http_text(script_url) for script_url in script_urls), return_exceptions=True
+    )
+    sources = [webpage] + [script for script in scripts if isinstance(script, str)]
 
     parsed_items: list[dict[str, str]] = []
     for source in sources:
@@ -356,44 +360,36 @@ def parse_video_id(value: str) -> str:
     raise ValueError(f'Invalid niconico URL or ID: {value}')
 
 
-def http_json(url: str, *, headers=None, query=None, data=None) -> dict:
-    import urllib.error
-    import urllib.parse
-    import urllib.request
-
-    if query:
-        url = f'{url}?{urllib.parse.urlencode(query)}'
+async def http_json(
+    url: str, *, headers=None, query=None, data=None, timeout: float = REQUEST_TIMEOUT
+) -> dict:
     req_headers = {'User-Agent': 'Mozilla/5.0', **(headers or {})}
-    request = urllib.request.Request(url, headers=req_headers, data=data)
-    try:
-        with urllib.request.urlopen(request, timeout=30) as response:
-            raw = response.read()
-    except urllib.error.HTTPError as exc:
-        try:
-            body = exc.read().decode('utf-8', errors='replace')
-        except Exception:
-            body = '<unreadable>'
-        if exc.code in {400, 404}:
-            return json.loads(body)
-        raise RuntimeError(f'HTTP {exc.code} for {url}: {body}') from exc
-    return json.loads(raw.decode('utf-8'))
-
-
-def fetch_api_data(video_id: str) -> dict:
-    return http_json(
+    async with rate_limiter(url).limit(), http_pool.request(
+        'GET' if data is None else 'POST',
+        url,
+        headers=req_headers,
+        params=query,
+        data=data,
+        timeout=aiohttp.ClientTimeout(total=timeout),
+    ) as response:
+        body = await response.text(encoding='utf-8', errors='replace')
+        if response.status >= 400:
+            if response.status in {400, 404}:
+                return json.loads(body)
+            raise RuntimeError(f'HTTP {response.status} for {url}: {body}')
+    return json.loads(body)
+
+
+async def fetch_api_data(video_id: str) -> dict:
+    return await http_json(
         f'{BASE_URL}/api/watch/v3_guest/{video_id}',
         headers=HEADERS,
         query={'actionTrackId': f'AAAAAAAAAA_{round(time.time() * 1000)}'},
     )
 
 
-def fetch_page_data(video_id: str) -> dict:
-    import urllib.request
-
-    url = f'{BASE_URL}/watch/{video_id}'
-    request = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-    with urllib.request.urlopen(request, timeout=30) as response:
-        webpage = response.read().decode('utf-8', errors='replace')
+async def fetch_page_data(video_id: str) -> dict:
+    webpage = await http_text(f'{BASE_URL}/watch/{video_id}')
 
     mobj = re.search(
         r'<meta[^>]+name=["\']server-response["\'][^>]+content=(["\'])(?P<content>.+?)\1',
@@ -409,7 +405,7 @@ def fetch_page_data(video_id: str) -> dict:
     }
 
 
-def fetch_comments(api_data: dict, *, flatten: bool = True) -> list[dict]:
+async def fetch_comments(api_data: dict, *, flatten: bool = True) -> list[dict]:
     comments_info = (((api_data.get('data') or {}).get('comment') or {}).get('nvComment') or {})
     server = comments_info.get('server')
     if not server:
@@ -420,7 +416,7 @@ def fetch_comments(api_data: dict, *, flatten: bool = True) -> list[dict]:
         'params': comments_info.get('params'),
         'threadKey': comments_info.get('threadKey'),
     }
-    threads_resp = http_json(
+    threads_resp = await http_json(
         f'{server}/v1/threads',
         headers={
             'Content-Type': 'text/plain;charset=UTF-8',
@@ -449,22 +445,16 @@ class NicoNicoSource(DanmakuSource):
         self.series: int|None = options.get("series")
         self.offset: int = options.get("offset", 0)
 
-    def _update_series_info(self) -> dict|None:
+    async def _update_series_info(self) -> dict|None:
         if self.series is not None:
-            _series_map = get_series_data(str(self.series))
+            _series_map = await get_series_data(str(self.series))
         else:
             if self.context.ids is None or self.context.ids.bgm_id is None:
                 logger.error("Failed to get bgm id")
                 return
             bgm_id = self.context.ids.bgm_id
-            for item in self.context.bangumi_data:
-                if not any(
-                    site["site"] == "bangumi" and site["id"] == str(bgm_id)
-                    for site in item["sites"]
-                ):
-                    continue
-                break
-            else:
+            item = self.context.db.find_bangumi_data("bangumi", str(bgm_id))
+            if item is None:
                 logger.error("bangumi not found in bangumi-data")
                 return None
             logger.debug("Found anime, title: %s", item["title"])
@@ -475,7 +465,7 @@ class NicoNicoSource(DanmakuSource):
                 return None
             nico_anime_id = item["sites"][sites.index("nicovideo")]["id"]
             logger.debug("Get nico_anime_id: %s", nico_anime_id)
-            _series_map = get_detail_data(nico_anime_id)
+            _series_map = await get_detail_data(nico_anime_id)
 
         series_map: dict[str, Any] = {
             "series": self.series,
@@ -494,7 +484,7 @@ class NicoNicoSource(DanmakuSource):
             return {}
 
 
-    def map_ep(self, ep: int):
+    async def map_ep(self, ep: int):
         ep += self.offset
         info = self._get_series_info()
         if (
@@ -502,7 +492,7 @@ class NicoNicoSource(DanmakuSource):
             or info.get("offset") != self.offset
             or info.get(str(ep)) is None
         ):
-            info = self._update_series_info()
+            info = await self._update_series_info()
             if info is None:
                 return None
         try:
@@ -532,8 +522,8 @@ class NicoNicoSource(DanmakuSource):
             danmaku_new.append({"p": f"{timestamp},{pos},{color},{user}", "m": comment})
         return danmaku_new
 
-    def fetch(self, ep: int) -> tuple[list[dict], str, str] | None:
-        video_id = self.map_ep(ep)
+    async def fetch(self, ep: int) -> tuple[list[dict], str, str] | None:
+        video_id = await self.map_ep(ep)
         if video_id is None:
             return None
         logger.debug("NicoNico video_id: %s", video_id)
@@ -541,8 +531,8 @@ class NicoNicoSource(DanmakuSource):
         out_path = self.context.data_path / f'{video_id}.comments.json'
 
         if self.context.db.is_outdated(out_path):
-            api_data = fetch_page_data(video_id)
-            result = fetch_comments(api_data, flatten=True)
+            api_data = await fetch_page_data(video_id)
+            result = await fetch_comments(api_data, flatten=True)
             desc = api_data["data"]["video"]["title"]
             out_path.write_text(json.dumps({"result": result, "desc": desc}, ensure_ascii=False, indent=2), encoding='utf-8')
         else:
@@ -554,34 +544,39 @@ class NicoNicoSource(DanmakuSource):
 async def niconico_fetch_danmaku(
     ctx: "MPVBangumi", episode_id: int, options: dict, context: DanmakuSource.Context
 ):
-    with portalocker.Lock(
-        context.data_path.joinpath("update.lock"),
-        mode="w",
-        flags=portalocker.LockFlags.EXCLUSIVE,
-    ):
-        res = await asyncio.to_thread(
-            lambda: NicoNicoSource(options, context).fetch(episode_id % 10000)
-        )
-        if not res:
-            logger.warning("Failed to get nicovideo danmaku!")
-            return
-        danmaku, desc, video_id = res
-        logger.info("nicovideo title: %s", desc)
-
-        if config.llm and config.llm.enabled and os.environ.get("LLM_API_KEY"):
-            logger.info("Start trasnlation with LLM")
-            from bgm.llm import DanmakuTranslator
-            translator = DanmakuTranslator(context.data_path, video_id)
-            try:
-                async def on_translation_update(partial_danmaku, done):
-                    ctx.update_comments("niconico", partial_danmaku, silent=not done)
-
-                await translator.translate(danmaku, desc, on_update=on_translation_update)
-            except Exception:
-                logger.warning("llm: translation failed, using original danmaku")
+    lock_path = context.data_path.joinpath("update.lock")
+    async with context.db.update_lock(lock_path):
+        with portalocker.Lock(
+            lock_path,
+            mode="w",
+            flags=portalocker.LockFlags.EXCLUSIVE,
+        ):
+            res = await NicoNicoSource(options, context).fetch(episode_id % 10000)
+            if not res:
+                logger.warning("Failed to get nicovideo danmaku!")
+                return
+            danmaku, desc, video_id = res
+            logger.info("nicovideo title: %s", desc)
+
+            if config.llm and config.llm.enabled and os.environ.get("LLM_API_KEY"):
+                logger.info("Start trasnlation with LLM")
+                from bgm.llm import DanmakuTranslator
+                translator = DanmakuTranslator(context.data_path, video_id)
+                try:
+                    async def on_translation_update(partial_danmaku, done):
+                        ctx.update_comments("niconico", partial_danmaku, silent=not done)
+
+                    await translator.translate(
+                        danmaku,
+                        desc,
+                        on_update=on_translation_update,
+                        playhead=ctx.get_time_pos,
+                    )
+                except Exception:
+                    logger.warning("llm: translation failed, using original danmaku")
+                    ctx.update_comments("niconico", danmaku)
+            else:
                 ctx.update_comments("niconico", danmaku)
-        else:
-            ctx.update_comments("niconico", danmaku)
 
 def main() -> int:
     import argparse
@@ -597,9 +592,17 @@ def main() -> int:
 
     args = parser.parse_args()
 
+    try:
+        return asyncio.run(_main(args))
+    except Exception as exc:
+        print(f'ERROR: {exc}')
+        return 1
+
+
+async def _main(args) -> int:
     try:
         video_id = parse_video_id(args.video)
-        api_data = fetch_api_data(video_id)
+        api_data = await fetch_api_data(video_id)
 
         status = ((api_data.get('meta') or {}).get('status'))
         if status and status != 200:
@@ -610,16 +613,15 @@ def main() -> int:
         comments_info = (((api_data.get('data') or {}).get('comment') or {}).get('nvComment') or {})
         if not comments_info.get('server'):
             print('Info: nvComment data missing from guest API response; falling back to watch page metadata...')
-            api_data = fetch_page_data(video_id)
+            api_data = await fetch_page_data(video_id)
 
-        result = fetch_comments(api_data, flatten=not args.raw_threads)
+        result = await fetch_comments(api_data, flatten=not args.raw_threads)
         out_path = Path(args.output or f'{video_id}.comments.json')
         out_path.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding='utf-8')
         print(f'Wrote {len(result)} {"threads" if args.raw_threads else "comments"} to {out_path}')
         return 0
-    except Exception as exc:
-        print(f'ERROR: {exc}')
-        return 1
+    finally:
+        await http_pool.close()
 
 
 if __name__ == '__main__':
@@ -1,13 +1,16 @@
 import asyncio
+import hashlib
 from sqlite3.dbapi2 import Time
 from typing import Literal, Protocol, TYPE_CHECKING
 import json
 from dataclasses import dataclass
 from pathlib import Path
 
+import aiohttp
 import portalocker
 
 from bgm import DATA_PATH, logger
+from bgm.api import http_pool, rate_limiter
 from bgm.db import DB, IDS, EpisodeMatch, db
 
 if TYPE_CHECKING:
@@ -17,13 +20,12 @@ class DanmakuSource(Protocol):
     @dataclass
     class Context:
         data_path: Path
-        bangumi_data: list[dict]
         ids: IDS | None = None
         db: DB = db
 
     def __init__(self, options: dict, context: Context): ...
 
-    def fetch(self, ep: int) -> tuple[list[dict], str, str] | None: ...
+    async def fetch(self, ep: int) -> tuple[list[dict], str, str] | None: ...
 
 
 async def get_sources(ctx: "MPVBangumi", episode_info: 'EpisodeMatch') -> None:
@@ -46,6 +48,7 @@ async def get_sources(ctx: "MPVBangumi", episode_info: 'EpisodeMatch') -> None:
 
         data_path = DATA_PATH / f"metadata/{episode_info.animeId}/cache_{source}"
         data_path.mkdir(exist_ok=True, parents=True)
+        await update_bangumi_data()
 
         ctx.send_action(
             "fetch-danmaku",
@@ -55,7 +58,6 @@ async def get_sources(ctx: "MPVBangumi", episode_info: 'EpisodeMatch') -> None:
                 "options": info,
                 "context": DanmakuSource.Context(
                     data_path=data_path,
-                    bangumi_data=(await get_or_update_bangumi_data())["items"],
                     ids=db.get(
                         dandanplay_id=episode_info.episodeId,
                     ),
@@ -75,29 +77,54 @@ async def set_source_status(ctx: "MPVBangumi", episode_info: EpisodeMatch, statu
 
 
 # --- bangumi data ---
-def get_bangumi_data():
-    bangumi_data_path = DATA_PATH.joinpath("bangumi-data.json")
-    if bangumi_data_path.exists():
-        try:
-            return json.loads(bangumi_data_path.read_text(encoding='utf-8'))
-        except json.JSONDecodeError:
-            return None
-    return None
-
-def _get_or_update_bangumi_data() -> dict:
-    with db.check_update(DATA_PATH.joinpath("bangumi-data.json"), 7 * 24 * 3600) as writer:
-        if writer is not None:
-            import requests
-            res = requests.get("https://unpkg.com/bangumi-data@0.3/dist/data.json")
-            res_json = res.json()
-            writer(json.dumps(res_json, ensure_ascii=False))
-            return res_json
-
-    data = get_bangumi_data()
-    assert data is not None
-    return data
-
-async def get_or_update_bangumi_data() -> dict:
-    DATA_PATH.mkdir(parents=True, exist_ok=True)
-    return await asyncio.to_thread(_get_or_update_bangumi_data)
+BANGUMI_DATA_URL = "https://unpkg.com/bangumi-data@0.3/dist/data.json"
+
+
+BANGUMI_DATA_MAX_AGE = 7 * 24 * 3600
+# several MB, the pool's total timeout is too short for slow links
+BANGUMI_DATA_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+
 
+def _diff_bangumi_data(content: bytes, known: set[str]) -> tuple[dict[str, dict], set[str]]:
+    """(new or changed items by content hash, hashes no longer upstream)"""
+    items: dict[str, dict] = {}
+    for item in json.loads(content)["items"]:
+        key = hashlib.sha1(
+            json.dumps(item, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+        items[key] = item
+    added = {h: item for h, item in items.items() if h not in known}
+    return added, known - items.keys()
+
+
+async def update_bangumi_data():
+    """ingest bangumi-data into the db index, only changed items are written"""
+    DATA_PATH.mkdir(parents=True, exist_ok=True)
+    # stores only a summary, the items live in data.db
+    version_path = DATA_PATH.joinpath("bangumi-data.version")
+    if not db.has_bangumi_data():
+        version_path.unlink(missing_ok=True)
+    async with db.check_update_async(version_path, BANGUMI_DATA_MAX_AGE) as writer:
+        if writer is None:
+            return
+        async with rate_limiter(BANGUMI_DATA_URL).limit(), http_pool.request(
+            "GET",
+            BANGUMI_DATA_URL,
+            headers=writer.conditional_headers,
+            timeout=BANGUMI_DATA_TIMEOUT,
+        ) as res:
+            if res.status == 304:
+                writer.set_not_modified()
+                return
+            res.raise_for_status()
+            content = await res.read()
+            headers = res.headers
+
+        known = db.get_bangumi_data_hashes()
+        added, removed = await asyncio.to_thread(_diff_bangumi_data, content, known)
+        db.update_bangumi_data(added, removed)
+        writer.set_validators(headers)
+        writer(json.dumps({"added": len(added), "removed": len(removed)}))
+        logger.info("bangumi-data: %d items added, %d removed", len(added), len(removed))
+        # superseded by the index
+        DATA_PATH.joinpath("bangumi-data.json").unlink(missing_ok=True)
@@ -0,0 +1,163 @@
+"""Record/replay transport for offline runs and benchmarks.
+
+BGM_HTTP_RECORD=<dir>  save every request/response pair to <dir>
+BGM_HTTP_REPLAY=<url>  send every request to a stand-in server started with
+                       `python -m bgm.transport serve <dir>`
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+import aiohttp
+from yarl import URL
+
+from bgm import logger
+
+if TYPE_CHECKING:
+    # only needed by the stand-in server, aiohttp.web is slow to import
+    from aiohttp import web
+
+# headers that no longer describe the stored (decoded) body
+_DROP_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection"}
+
+
+def fixture_key(method: str, url: URL, body: bytes) -> str:
+    """request identity, independent of headers (signatures, timestamps)"""
+    query = "&".join(f"{k}={v}" for k, v in sorted(url.query.items()))
+    h = hashlib.sha1(f"{method} {url.host}{url.path}?{query}\n".encode("utf-8"))
+    h.update(body)
+    return h.hexdigest()
+
+
+class Transport:
+    def __init__(self) -> None:
+        record_dir = os.environ.get("BGM_HTTP_RECORD")
+        replay_url = os.environ.get("BGM_HTTP_REPLAY")
+        self.record_dir = Path(record_dir) if record_dir else None
+        self.replay_url = URL(replay_url) if replay_url else None
+        if self.record_dir:
+            self.record_dir.mkdir(parents=True, exist_ok=True)
+            logger.info("transport: recording to %s", self.record_dir)
+        if self.replay_url:
+            logger.info("transport: replaying from %s", self.replay_url)
+
+    @property
+    def active(self) -> bool:
+        return self.record_dir is not None or self.replay_url is not None
+
+    @staticmethod
+    def prepare(url: str, kwargs: dict) -> tuple[URL, bytes]:
+        """serialize params and body ourselves, so the recorded key matches what is sent"""
+        url_ = URL(url)
+        if params := kwargs.pop("params", None):
+            url_ = url_.update_query({k: str(v) for k, v in params.items()})
+        body = b""
+        if "json" in kwargs:
+            body = json.dumps(kwargs.pop("json")).encode("utf-8")
+            kwargs["headers"] = {"Content-Type": "application/json"} | (
+                kwargs.get("headers") or {}
+            )
+        elif (data := kwargs.get("data")) is not None:
+            body = data.encode("utf-8") if isinstance(data, str) else bytes(data)
+        if body:
+            kwargs["data"] = body
+        return url_, body
+
+    def rewrite(self, url: URL) -> URL:
+        assert self.replay_url is not None
+        return self.replay_url.with_path(
+            f"/{url.scheme}/{url.host}{url.path}"
+        ).with_query(url.query)
+
+    async def record(
+        self, method: str, url: URL, body: bytes, res: aiohttp.ClientResponse
+    ):
+        assert self.record_dir is not None
+        content = await res.read()
+        key = fixture_key(method, url, body)
+        (self.record_dir / f"{key}.body").write_bytes(content)
+        meta = {
+            "method": method,
+            "url": str(url),
+            "status": res.status,
+            "headers": {
+                k: v for k, v in res.headers.items() if k.lower() not in _DROP_HEADERS
+            },
+        }
+        (self.record_dir / f"{key}.json").write_text(
+            json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8"
+        )
+        logger.debug("transport: recorded %s %s", method, url)
+
+
+transport = Transport()
+
+
+# stand-in server >>> ----------------------------------------------------------
+
+
+def make_app(fixtures: Path, latency: float = 0.0, bandwidth: float = 0.0) -> "web.Application":
+    """serve recorded fixtures, `bandwidth` in bytes/s (0 for unlimited)"""
+    from aiohttp import web
+
+    async def handle(request: web.Request) -> web.StreamResponse:
+        scheme, _, rest = request.path.lstrip("/").partition("/")
+        url = URL(f"{scheme}://{rest}").with_query(request.query)
+        key = fixture_key(request.method, url, await request.read())
+        meta_path = fixtures / f"{key}.json"
+        if not meta_path.exists():
+            logger.warning("transport: no fixture for %s %s", request.method, url)
+            return web.Response(status=502, text=f"no fixture for {request.method} {url}")
+
+        meta: dict[str, Any] = json.loads(meta_path.read_text(encoding="utf-8"))
+        content = (fixtures / f"{key}.body").read_bytes()
+        if latency:
+            await asyncio.sleep(latency)
+
+        response = web.StreamResponse(status=meta["status"], headers=meta["headers"])
+        response.content_length = len(content)
+        await response.prepare(request)
+        chunk_size = 16 * 1024
+        for start in range(0, len(content), chunk_size):
+            chunk = content[start : start + chunk_size]
+            await response.write(chunk)
+            if bandwidth:
+                await asyncio.sleep(len(chunk) / bandwidth)
+        await response.write_eof()
+        return response
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_route("*", "/{tail:.*}", handle)
+    return app
+
+
+def main() -> int:
+    from aiohttp import web
+
+    parser = argparse.ArgumentParser(description="bgm record/replay transport")
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve = sub.add_parser("serve", help="serve recorded fixtures as a stand-in server")
+    serve.add_argument("fixtures", type=Path)
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--latency", type=float, default=0.0, help="seconds per response")
+    serve.add_argument("--bandwidth", type=float, default=0.0, help="bytes per second")
+    args = parser.parse_args()
+
+    print(f"BGM_HTTP_REPLAY=http://{args.host}:{args.port}")
+    web.run_app(
+        make_app(args.fixtures, args.latency, args.bandwidth),
+        host=args.host,
+        port=args.port,
+        print=None,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
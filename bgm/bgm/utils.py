@@ -1,71 +1,7 @@
-from functools import reduce
-import re
-from pydantic import BaseModel
 import asyncio
+import concurrent.futures
 import threading
 
-class InfoFromFileName(BaseModel):
-    title: str | None
-    tags: list[str]
-    episode: int | None
-
-
-def extract_info_from_filename(filename: str) -> InfoFromFileName:
-    filename = filename.strip().rsplit(".", 1)[0]  # Remove file extension
-    tags_re = re.compile(r"[\[\(（【第](.+?)[\]\)）】话話]")
-    # tags_re = "|".join(
-    #     rf"{lb}(.+?){rb}"
-    #     for lb, rb in zip(["\\[", "\\(", "（", "【"], ["\\]", "\\)", "）", "】"])
-    # )
-    tags = tags_re.findall(filename)
-    tags = list(map(str.strip, tags))
-    _ = re.split(tags_re, filename)[::2]
-    _ = reduce(lambda x, y: x + y, [s.split() for s in _], [])
-    title_parts = list(filter(bool, map(str.strip, _)))
-
-    for tag in tags:
-        if res := re.match(r"^(\d+)(v\d|end)?$", tag, re.IGNORECASE):
-            episode = int(res.group(1))
-            break
-        if res := re.match(r"^ep_?(\d+).*$", tag, re.IGNORECASE):
-            episode = int(res.group(1))
-            break
-    else:
-        for i, part in enumerate(title_parts):
-            # ANi style
-            if (
-                part == "Season"
-                and i + 3 < len(title_parts)
-                and title_parts[i + 1].isdigit()
-                and title_parts[i + 2] == "-"
-                and title_parts[i + 3].isdigit()
-            ):
-                episode = int(title_parts[i + 3])
-                title_parts = title_parts[: i + 2] + title_parts[i + 4 :]
-                break
-
-            if (
-                (res := re.search(r"-?ep(\d+)-?", part, re.IGNORECASE))
-                or (res := re.search(r"-?s\d+e(\d+)-?", part, re.IGNORECASE))
-                or (res := re.match(r"-?(\d+)(v\d|end)?-?$", part, re.IGNORECASE))
-                or (res := re.match(r"-?(\d+)-?$", part))
-            ):
-                episode = int(res.group(1))
-                title_parts[i] = part[: res.start()] + " " + part[res.end() :]
-                if not title_parts[i].strip():
-                    title_parts[i] = "-"
-                break
-        else:
-            episode = None
-
-    if not title_parts:
-        title = None
-    else:
-        title_parts = [p for p in title_parts if p != "-"]
-        title = " ".join(title_parts)
-
-    return InfoFromFileName(title=title, tags=tags, episode=episode)
-
 
 class AsyncWorker:
     def __init__(self):
@@ -82,8 +18,19 @@ class AsyncWorker:
             self.loop.call_soon_threadsafe(self.loop.stop)
             self.thread.join()
 
-    def submit_task(self, coro):
+    def run(self, coro, timeout: float | None = 5):
+        """run a coroutine on the worker loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def submit_task(self, coro) -> "asyncio.Future | concurrent.futures.Future":
         if asyncio._get_running_loop() is None:
-            asyncio.run_coroutine_threadsafe(coro, self.loop)
+            return asyncio.run_coroutine_threadsafe(coro, self.loop)
+        else:
+            return asyncio.create_task(coro)
+
+    def cancel(self, fut: "asyncio.Future | concurrent.futures.Future"):
+        """cancel a future returned by submit_task, from any thread"""
+        if isinstance(fut, asyncio.Future):
+            self.loop.call_soon_threadsafe(fut.cancel)
         else:
-            asyncio.create_task(coro)
+            fut.cancel()
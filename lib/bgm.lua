@@ -20,12 +20,23 @@ function M.match(force_id)
   if not file_info or not file_info.is_file then
     mp.msg.error("文件不存在或不是有效的文件: " .. file_path)
     mp.osd_message("文件不存在或不是有效的文件: " .. file_path, 3)
+    -- no match follows, the tasks of the previous file still have to go
+    M.send_action("reset", {})
     return
   end
 
+  -- local files in the playlist are matched together in one batch
+  local playlist = {}
+  for _, item in ipairs(mp.get_property_native("playlist", {})) do
+    if not utils.is_protocol(item.filename) then
+      table.insert(playlist, mp.command_native({ "normalize-path", item.filename }))
+    end
+  end
+
   M.send_action("match", {
     path = file_path,
-    force_id = force_id
+    force_id = force_id,
+    playlist = playlist
   })
 end
 function M.send_danmaku(episode_id, comment)
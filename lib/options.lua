@@ -3,6 +3,8 @@ local mp_utils = require "mp.utils"
 
 Options = {
   bgm_path = "",
+  -- 多个mpv实例共用同一个常驻的bgm进程
+  daemon = false,
 
   -- 发送弹幕时默认的颜色和位置
   user_default_danmaku_color = "white",
@@ -144,6 +144,20 @@ function M.subprocess_err()
   }
 end
 
+-- 读取并删除python端写入的大体积消息
+---@param path string
+function M.read_payload(path)
+  local file = io.open(path, "rb")
+  if not file then
+    mp.msg.error("无法读取消息文件: " .. path)
+    return nil
+  end
+  local content = file:read "*a"
+  file:close()
+  os.remove(path)
+  return mp_utils.parse_json(content)
+end
+
 function M.is_protocol(path)
     return type(path) == 'string' and (path:find('^%a[%w.+-]-://') ~= nil or path:find('^%a[%w.+-]-:%?') ~= nil)
 end
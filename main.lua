@@ -77,7 +77,11 @@ local function init_bgm()
     end
   end)
 
-  mp_utils.subprocess_detached({args={Options.bgm_path, ipc_path}})
+  local args = { Options.bgm_path, ipc_path }
+  if Options.daemon then
+    args = { Options.bgm_path, "--daemon", ipc_path }
+  end
+  mp_utils.subprocess_detached({ args = args })
 end
 
 local function init_bangumi_timer()
@@ -106,6 +110,13 @@ local function init_bangumi_timer()
   end)
 end
 
+-- cancels the python tasks started for the previous file, a match does it itself
+local function reset_bgm_tasks()
+  if BgmReady then
+    bgm.send_action("reset", {})
+  end
+end
+
 local function init(episode_id)
   reset_globals()
   if BgmReady then
@@ -118,6 +129,7 @@ end
 mp.register_event("file-loaded", function()
   if utils.is_protocol(mp.get_property "path") then
     mp.msg.verbose("Skipping init for protocol:", mp.get_property "path")
+    reset_bgm_tasks()
     return
   end
   init()
@@ -396,9 +408,20 @@ mp.register_script_message("mpvbangumi-action", function(_args)
 
   local action = args.action
   local data = args.data
+  if args.file then
+    data = utils.read_payload(args.file)
+    if type(data) ~= "table" then
+      mp.msg.error("Json parse error: ", args.file)
+      return
+    end
+  end
 
   if action == "log" then
     handle_log(data.level, data.msg)
+  elseif action == "logs" then
+    for _, record in ipairs(data.records) do
+      handle_log(record.level, record.msg)
+    end
   elseif action == "ready" then
     mp.msg.info("mpv python ipc ready")
     BgmReady = true